@@ -0,0 +1,136 @@
+from collections import deque
+
+from fuzzysearch import find_near_matches
+
+
+class AhoCorasick():
+    """Automaton that finds all occurrences of a set of keywords in a single
+    pass over a text."""
+
+    def __init__(self, keywords):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+        for keyword_id, keyword in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                if char not in self.transitions[state]:
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.transitions[state][char] = len(self.transitions) - 1
+                state = self.transitions[state][char]
+            self.outputs[state].append((keyword_id, len(keyword)))
+
+        queue = deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.transitions[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.transitions[fail_state].get(
+                    char, 0)
+                self.outputs[next_state] = (self.outputs[next_state] +
+                                            self.outputs[self.fail[next_state]])
+
+    def iter_matches(self, text):
+        """Yields (start position, keyword id) of every keyword occurrence."""
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            for keyword_id, length in outputs[state]:
+                yield position - length + 1, keyword_id
+
+
+def split_into_pieces(text, n_pieces):
+    """Splits text into n_pieces consecutive pieces of almost equal length
+    and returns them with their offsets."""
+    piece_length, remainder = divmod(len(text), n_pieces)
+    pieces = []
+    offset = 0
+    for n in range(n_pieces):
+        length = piece_length + (1 if n < remainder else 0)
+        pieces.append((text[offset:offset + length], offset))
+        offset += length
+    return pieces
+
+
+class AffiliationMatcher():
+    """Compiled form of the affiliation patterns of affiliations_path.
+
+    Exact patterns (max_l_dist: 0) are keywords of one shared Aho-Corasick
+    automaton. A fuzzy pattern with max_l_dist k is split into k + 1 pieces,
+    of which at least one occurs exactly in every match, so the pieces are
+    keywords of the same automaton as well. Only the windows around piece
+    occurrences are verified with a bounded Levenshtein search. Patterns too
+    short to be split are verified on the whole page."""
+
+    def __init__(self, affiliations):
+        self.organization_names = [
+            affiliation['name'] for affiliation in affiliations
+        ]
+        # keyword -> list of (organization, pattern, offset in pattern)
+        keyword_targets = {}
+        self.unfiltered_patterns = []
+
+        for organization, affiliation in enumerate(affiliations):
+            for pattern in affiliation['patterns']:
+                text = pattern['text']
+                max_l_dist = pattern['max_l_dist']
+                if max_l_dist == 0:
+                    keyword_targets.setdefault(text, []).append(
+                        (organization, None, 0))
+                elif len(text) // (max_l_dist + 1) >= 2:
+                    for piece, offset in split_into_pieces(
+                            text, max_l_dist + 1):
+                        keyword_targets.setdefault(piece, []).append(
+                            (organization, (text, max_l_dist), offset))
+                else:
+                    self.unfiltered_patterns.append(
+                        (organization, (text, max_l_dist)))
+
+        self.keywords = list(keyword_targets)
+        self.keyword_targets = [
+            keyword_targets[keyword] for keyword in self.keywords
+        ]
+        self.automaton = AhoCorasick(self.keywords)
+
+    def extract_affiliations(self, front_page):
+        found = set()
+        verified = set()
+
+        for start, keyword_id in self.automaton.iter_matches(front_page):
+            for organization, fuzzy_pattern, offset in self.keyword_targets[
+                    keyword_id]:
+                if organization in found:
+                    continue
+                if fuzzy_pattern is None:
+                    found.add(organization)
+                    continue
+
+                text, max_l_dist = fuzzy_pattern
+                window_start = max(0, start - offset - max_l_dist)
+                window_end = start - offset + len(text) + max_l_dist
+                if (fuzzy_pattern, window_start) in verified:
+                    continue
+                verified.add((fuzzy_pattern, window_start))
+                if find_near_matches(text,
+                                     front_page[window_start:window_end],
+                                     max_l_dist=max_l_dist):
+                    found.add(organization)
+
+        for organization, (text, max_l_dist) in self.unfiltered_patterns:
+            if organization in found:
+                continue
+            if find_near_matches(text, front_page, max_l_dist=max_l_dist):
+                found.add(organization)
+
+        return [self.organization_names[n] for n in sorted(found)]
@@ -5,9 +5,10 @@ import logging
 from flask import Flask, session, g, request
 
 from database import (Query, User, Organization, create_db_session,
-                      fulfill_paper_query, get_db_string,
-                      fulfill_get_saved_queries, get_organization, get_query,
-                      get_user, get_paper)
+                      create_scoped_db_session, fulfill_paper_query,
+                      fulfill_get_saved_queries, get_db_engine,
+                      get_db_pool_status, get_organization, get_query,
+                      get_saved_queries_by_priority, get_user, get_paper)
 from utils import Config
 from fetch_papers import initialize_tables
 from search import TfidfSearch
@@ -15,7 +16,16 @@ from search import TfidfSearch
 app = Flask(__name__)
 config = Config(os.getenv('CONFIG_PATH'))
 app.secret_key = config.secret_key
-tfidf = TfidfSearch(config)
+DbSession = create_scoped_db_session(config)
+
+
+def load_saved_queries():
+    db_session, _ = create_db_session(config)
+    try:
+        return get_saved_queries_by_priority(db_session)
+    finally:
+        db_session.close()
+
 
 gunicorn_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers = gunicorn_logger.handlers
@@ -23,14 +33,13 @@ app.logger.setLevel(gunicorn_logger.level)
 
 # initialize db tables if necessary
 initialize_tables(config)
+tfidf = TfidfSearch(config, saved_queries_loader=load_saved_queries)
 
 
 @app.before_request
 def before_request():
-    db_string = get_db_string(config)
-    db_session, db_engine = create_db_session(db_string)
-    g.db_session = db_session
-    g.db_engine = db_engine
+    tfidf.poll_index_generation()
+    g.db_session = DbSession()
 
     if 'user_id' in session:
         g.user = get_user(db_session=g.db_session, user_id=session['user_id'])
@@ -40,17 +49,31 @@ def before_request():
 
 @app.teardown_request
 def close_db_connection(exception):
-    g.db_session.close()
+    # returns the connection to the pool
+    DbSession.remove()
 
 
 @app.route('/admin/flush', methods=['POST'])
 def flush_tfidf_cache():
+    # the other workers pick up the new generation by polling
     tfidf.load_document_vectors()
-    tfidf.flush_cache()
 
     return 'OK', 200
 
 
+@app.route('/admin/cache', methods=['GET'])
+def get_cache_status():
+    status = tfidf.cache.stats.to_dict()
+    status.update(tfidf.cache.usage())
+    status['generation'] = tfidf.generation
+    return status
+
+
+@app.route('/admin/pool', methods=['GET'])
+def get_pool_status():
+    return get_db_pool_status(get_db_engine(config))
+
+
 @app.route('/api/categories', methods=['GET'])
 def get_categories():
     return {'categories': config.categories}
@@ -79,7 +102,8 @@ def get_papers():
         query_type=request.args.get('query_type', 'full_text'),
         search_query=request.args.get('query', None),
         similar_id=request.args.get('similar_id', None),
-        offset=int(request.args.get('offset', 0)))
+        offset=int(request.args.get('offset', 0)),
+        cursor=request.args.get('cursor', None))
 
 
 @app.route('/api/saved', methods=['GET'])
@@ -0,0 +1,91 @@
+import datetime
+import logging
+import xml.etree.ElementTree as ET
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+ATOM_NAMESPACE = '{http://www.w3.org/2005/Atom}'
+ARXIV_NAMESPACE = '{http://arxiv.org/schemas/atom}'
+OPENSEARCH_NAMESPACE = '{http://a9.com/-/spec/opensearch/1.1/}'
+
+ENTRY_TAG = ATOM_NAMESPACE + 'entry'
+TOTAL_RESULTS_TAG = OPENSEARCH_NAMESPACE + 'totalResults'
+
+# child elements of an entry whose text is kept, by the key feedparser gives
+# them, so that the entries can go through harvester.convert_feedparser
+TEXT_ELEMENTS = {
+    ATOM_NAMESPACE + 'id': 'id',
+    ATOM_NAMESPACE + 'published': 'published',
+    ATOM_NAMESPACE + 'updated': 'updated',
+    ATOM_NAMESPACE + 'title': 'title',
+    ATOM_NAMESPACE + 'summary': 'summary',
+    ARXIV_NAMESPACE + 'journal_ref': 'arxiv_journal_ref',
+    ARXIV_NAMESPACE + 'doi': 'arxiv_doi'
+}
+
+
+def parse_timestamp(value):
+    """Parses the fixed format UTC timestamps of the arXiv API, e.g.
+    '2021-01-04T18:59:59Z', without going through strptime."""
+    return datetime.datetime.fromisoformat(
+        value.rstrip('Z')).replace(tzinfo=pytz.utc)
+
+
+def convert_entry(entry_element):
+    """Returns the arXiv Atom entry element as the subset of the feedparser
+    entry dict that convert_feedparser reads, with the timestamps parsed."""
+    entry = {'authors': [], 'tags': []}
+    for child in entry_element:
+        key = TEXT_ELEMENTS.get(child.tag)
+        if key is not None:
+            # feedparser strips the text of the elements as well
+            entry[key] = (child.text or '').strip()
+        elif child.tag == ATOM_NAMESPACE + 'author':
+            name = child.find(ATOM_NAMESPACE + 'name')
+            if name is not None:
+                entry['authors'].append({'name': (name.text or '').strip()})
+        elif child.tag == ATOM_NAMESPACE + 'category':
+            entry['tags'].append({'term': child.get('term')})
+        elif child.tag == ARXIV_NAMESPACE + 'primary_category':
+            entry['arxiv_primary_category'] = {'term': child.get('term')}
+    entry['published'] = parse_timestamp(entry['published'])
+    entry['updated'] = parse_timestamp(entry['updated'])
+    return entry
+
+
+def parse_arxiv_feed(chunks):
+    """Parses an arXiv API response given as an iterable of byte chunks with
+    an incremental pull parser. Every entry is converted and dropped from the
+    tree once it is complete, so the whole document is never built. Returns
+    the entries, as by convert_entry, and the total number of results of the
+    query, or None if the response does not state it. Raises
+    xml.etree.ElementTree.ParseError on malformed responses."""
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    entries = []
+    total_results = None
+    depth = 0
+    feed = None
+
+    def handle_events():
+        nonlocal depth, feed, total_results
+        for event, element in parser.read_events():
+            if event == 'start':
+                if depth == 0:
+                    feed = element
+                depth += 1
+                continue
+            depth -= 1
+            if element.tag == ENTRY_TAG and depth == 1:
+                entries.append(convert_entry(element))
+                feed.remove(element)
+            elif element.tag == TOTAL_RESULTS_TAG and depth == 1:
+                total_results = int(element.text)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        handle_events()
+    parser.close()
+    handle_events()
+    return entries, total_results
@@ -0,0 +1,113 @@
+"""Compares the parsing of arXiv API responses with feedparser, as the
+harvester used to do it, to the streaming parser of arxiv_feed on responses
+recorded in a directory. Both paths must produce the same metadata dicts.
+
+Record responses of the categories of the config first, then benchmark them:
+
+    CONFIG_PATH=/config/config.yaml python benchmark_feed_parsing.py \\
+        --record 20 /data/recorded_responses
+    python benchmark_feed_parsing.py /data/recorded_responses
+"""
+import os
+import sys
+import time
+import datetime
+import argparse
+import logging
+
+import pytz
+import feedparser
+
+from harvester import call_arxiv_api, convert_feedparser, parse_arxiv_response
+from utils import Config
+
+logger = logging.getLogger(__name__)
+
+
+def parse_arxiv_response_with_feedparser(content):
+    parsed_feed = feedparser.parse(content)
+    for entry in parsed_feed['entries']:
+        entry['published'] = datetime.datetime.strptime(
+            entry['published'] + '+0000',
+            '%Y-%m-%dT%H:%M:%SZ%z').astimezone(pytz.utc)
+        entry['updated'] = datetime.datetime.strptime(
+            entry['updated'] + '+0000',
+            '%Y-%m-%dT%H:%M:%SZ%z').astimezone(pytz.utc)
+    total_results = parsed_feed['feed'].get('opensearch_totalresults')
+    return ([(entry['published'], convert_feedparser(entry))
+             for entry in parsed_feed['entries']],
+            int(total_results) if total_results is not None else None)
+
+
+def record_responses(config, responses_dir, n_pages, page_size):
+    os.makedirs(responses_dir, exist_ok=True)
+    search_query = 'cat:' + ' OR cat:'.join(config.categories)
+    for page in range(n_pages):
+        response = call_arxiv_api(config.arxiv_base_url,
+                                  search_query,
+                                  page * page_size,
+                                  page_size,
+                                  sort_by='submittedDate',
+                                  sort_order='descending')
+        response.raise_for_status()
+        with open(os.path.join(responses_dir, 'page-{:05d}.xml'.format(page)),
+                  'wb') as file:
+            file.write(response.content)
+        logger.info('recorded page {}/{}'.format(page + 1, n_pages))
+        time.sleep(config.harvest_request_interval_sec)
+
+
+def time_parser(parse, responses, repeat):
+    best_sec = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in responses:
+            parse(content)
+        best_sec = min(best_sec, time.perf_counter() - start)
+    return best_sec
+
+
+def benchmark(responses_dir, repeat):
+    file_names = sorted(os.listdir(responses_dir))
+    responses = []
+    for file_name in file_names:
+        with open(os.path.join(responses_dir, file_name), 'rb') as file:
+            responses.append(file.read())
+
+    n_entries = 0
+    for file_name, content in zip(file_names, responses):
+        streamed = parse_arxiv_response(content)
+        if streamed != parse_arxiv_response_with_feedparser(content):
+            raise RuntimeError('The parsers disagree on {}'.format(file_name))
+        n_entries += len(streamed[0])
+
+    logger.info('{} responses with {} entries, best of {} runs'.format(
+        len(responses), n_entries, repeat))
+    for name, parse in [('feedparser', parse_arxiv_response_with_feedparser),
+                        ('streaming', parse_arxiv_response)]:
+        seconds = time_parser(parse, responses, repeat)
+        logger.info('{:>10}: {:.3f}s, {:.0f} entries/s'.format(
+            name, seconds, n_entries / seconds))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('responses_dir')
+    parser.add_argument('--record',
+                        type=int,
+                        metavar='N_PAGES',
+                        help='record N_PAGES responses from the arXiv API '
+                        'before benchmarking, needs CONFIG_PATH')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        record_responses(Config(os.getenv('CONFIG_PATH')), args.responses_dir,
+                         args.record, args.page_size)
+    benchmark(args.responses_dir, args.repeat)
@@ -1,8 +1,38 @@
 class FilenameConstants:
-    VECTORIZED_PAPERS = 'vectorized_papers.pkl'
+    CURRENT_INDEX = 'CURRENT'
+    INDEX_METADATA = 'index.json'
+
+    PAPERS_INDEX = 'papers'
+    PAPERS_POSTINGS = 'papers_postings'
     TFIDF_PIPELINE_PAPERS = 'tfidf_pipeline_papers.pkl'
-    PAPER_ID_MAP = 'paper_id_map.pkl'
 
-    VECTORIZED_AUTHORS = 'vectorized_authors.pkl'
+    AUTHORS_INDEX = 'authors'
+    AUTHORS_SEGMENTS_DIR = 'authors_segments'
     TFIDF_PIPELINE_AUTHORS = 'tfidf_pipeline_authors.pkl'
-    PAPER_ID_MAP_AUTHORS = 'paper_id_map_authors.pkl'
+
+    NEIGHBOURS_INDEX = 'neighbours'
+    NEIGHBOUR_POSITIONS = 'positions.npy'
+    NEIGHBOUR_SCORES = 'scores.npy'
+
+    SEGMENTS_DIR = 'segments'
+    SEGMENTS_MANIFEST = 'segments.json'
+    DOCUMENT_FREQUENCIES = 'document_frequencies.npy'
+    DELETED_ROWS = 'deleted.npy'
+    CHUNKS_DIR = 'chunks'
+
+    TOKEN_RECORDS = 'records'
+    TOKEN_VOCABULARY = 'vocabulary.txt'
+    TOKEN_VOCABULARY_HASH = 'vocab_hash.npy'
+
+    MATRIX_METADATA = 'matrix.json'
+    SPARSE_DATA = 'data.npy'
+    SPARSE_INDICES = 'indices.npy'
+    SPARSE_INDPTR = 'indptr.npy'
+    ROW_IDS = 'ids.npy'
+    PAPER_IDS = 'paper_ids.npy'
+    PAPER_ROWS_INDPTR = 'paper_rows_indptr.npy'
+
+    ROW_METADATA_LABELS = 'row_metadata.json'
+    ROW_CREATED = 'created.npy'
+    ROW_CATEGORIES = 'primary_categories.npy'
+    ROW_AFFILIATIONS = 'affiliations.npy'
@@ -1,18 +1,19 @@
 import os
-import pickle
 import hashlib
 import uuid
 import logging
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, String, Table, PickleType, BigInteger, ForeignKey
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy import (Column, String, Table, PickleType, BigInteger,
+                        ForeignKey, Index)
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import or_
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship
+from sqlalchemy import or_, func, tuple_
+from sqlalchemy.dialects.postgresql import insert, ARRAY, JSONB
 
-from utils import (download_paper, extract_affiliations,
-                   time_filter_to_unix_timestamp)
-from paper_processing import convert_pdf_to_text_pkl, paper_id_to_file_name
+from utils import (download_paper, time_filter_to_unix_timestamp, encode_cursor,
+                   decode_cursor)
+from paper_processing import paper_id_to_file_name
 
 logger = logging.getLogger(__name__)
 
@@ -23,18 +24,23 @@ def hash_password(salt, password):
     return hashlib.sha512((salt + password).encode('utf-8')).hexdigest()
 
 
-favorites_table = Table('favorites', Base.metadata,
-                        Column('paper_id', String, ForeignKey('papers.id')),
-                        Column('user_id', String, ForeignKey('users.id')))
+favorites_table = Table(
+    'favorites', Base.metadata,
+    Column('paper_id', String, ForeignKey('papers.id')),
+    Column('user_id', String, ForeignKey('users.id'), index=True))
 
 savedqueries_table = Table('savedqueries', Base.metadata,
                            Column('query_id', String, ForeignKey('queries.id')),
                            Column('user_id', String, ForeignKey('users.id')))
 
 affiliations_table = Table(
-    'affiliations', Base.metadata,
-    Column('paper_id', String, ForeignKey('papers.id')),
-    Column('organization_id', String, ForeignKey('organizations.id')))
+    'affiliations',
+    Base.metadata,
+    Column('paper_id', String, ForeignKey('papers.id'), index=True),
+    Column('organization_id', String, ForeignKey('organizations.id')),
+    # the affiliations filter looks up the papers of an organization
+    Index('ix_affiliations_organization_id_paper_id', 'organization_id',
+          'paper_id'))
 
 query_affiliations_table = Table(
     'query_affiliations', Base.metadata,
@@ -42,19 +48,40 @@ query_affiliations_table = Table(
     Column('organization_id', String, ForeignKey('organizations.id')))
 
 
-def assemble_paper_dicts(paper_query, user_favorites=None):
-    papers = []
-    for paper in paper_query:
-        paper_dict = paper.to_dict()
-        if user_favorites is not None:
-            if paper in user_favorites:
-                paper_dict['favorite'] = True
-            else:
-                paper_dict['favorite'] = False
+def assemble_paper_dicts(db_session, papers, user=None):
+    """Returns the dicts of papers with their affiliations and, if user is
+    given, whether they are favorites of user. Takes two queries, however
+    many papers and favorites there are."""
+    papers = list(papers)
+    if not papers:
+        return []
+    paper_ids = [paper.idx for paper in papers]
+
+    affiliations = {}
+    for paper_id, organization_id in db_session.query(
+            affiliations_table).filter(
+                affiliations_table.c.paper_id.in_(paper_ids)):
+        affiliations.setdefault(paper_id, []).append(organization_id)
+
+    favorite_ids = None
+    if user is not None:
+        favorite_ids = {
+            paper_id
+            for paper_id, in db_session.query(favorites_table.c.paper_id).
+            filter(favorites_table.c.user_id == user.idx,
+                   favorites_table.c.paper_id.in_(paper_ids))
+        }
+
+    paper_dicts = []
+    for paper in papers:
+        paper_dict = paper.to_dict(
+            affiliation_ids=affiliations.get(paper.idx, []))
+        if favorite_ids is not None:
+            paper_dict['favorite'] = paper.idx in favorite_ids
         else:
             paper_dict['favorite'] = None
-        papers.append(paper_dict)
-    return papers
+        paper_dicts.append(paper_dict)
+    return paper_dicts
 
 
 def get_user(db_session, user_id):
@@ -80,9 +107,95 @@ def fulfill_get_saved_queries(db_session, user):
     return {'saved_queries': saved_queries}
 
 
-def fulfill_paper_query(db_session, tfidf, config, user, tab, time_filter,
-                        categories, affiliations, query_type, search_query,
-                        similar_id, offset):
+def get_filter_metadata(db_session):
+    """Returns a dict of paper id to (created, primary category,
+    organization ids) and the list of all organization ids."""
+    affiliations = {}
+    for paper_id, organization_id in db_session.query(affiliations_table):
+        affiliations.setdefault(paper_id, []).append(organization_id)
+
+    filter_metadata = {
+        paper_id: (created, primary_category, affiliations.get(paper_id, []))
+        for paper_id, created, primary_category in db_session.query(
+            Paper.idx, Paper.created, Paper.primary_category)
+    }
+    organization_names = [
+        organization[0] for organization in db_session.query(Organization.idx)
+    ]
+    return filter_metadata, organization_names
+
+
+def get_saved_queries_by_priority(db_session):
+    """Returns the distinct saved searches as keyword arguments of
+    TfidfSearch.search, the ones saved by the most users first."""
+    affiliations = {}
+    for query_id, organization_id in db_session.query(query_affiliations_table):
+        affiliations.setdefault(query_id, []).append(organization_id)
+
+    n_users = dict(
+        db_session.query(savedqueries_table.c.query_id,
+                         func.count(savedqueries_table.c.user_id)).group_by(
+                             savedqueries_table.c.query_id))
+
+    priorities = {}
+    saved_queries = db_session.query(Query.idx, Query.search_string,
+                                     Query.search_type, Query.time,
+                                     Query.categories)
+    for query_id, search_string, search_type, time, categories in saved_queries:
+        if not search_string:
+            continue
+        categories = tuple(sorted(categories or []))
+        organizations = tuple(sorted(affiliations.get(query_id, [])))
+        key = (search_string, search_type, time, categories, organizations)
+        priorities[key] = priorities.get(key, 0) + n_users.get(query_id, 0)
+
+    return [{
+        'query_string': search_string,
+        'query_type': search_type,
+        'time_filter': time,
+        'categories': list(categories),
+        'affiliations': list(organizations)
+    } for search_string, search_type, time, categories, organizations in sorted(
+        priorities, key=priorities.get, reverse=True)]
+
+
+def is_json_int(value):
+    # bool is a subclass of int, but true and false are no valid cursor values
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def get_ranked_page(db_query, sorted_ids, start, page_size):
+    """Returns the papers of sorted_ids[start:start + page_size] that
+    db_query finds, in the order of sorted_ids, and the cursor of the next
+    page."""
+    page_ids = sorted_ids[start:start + page_size]
+    ranks = {paper_id: rank for rank, paper_id in enumerate(page_ids)}
+    papers = db_query.filter(Paper.idx.in_(page_ids)).with_entities(Paper).all()
+    papers.sort(key=lambda paper: ranks[paper.idx])
+
+    next_start = start + page_size
+    if next_start < len(sorted_ids):
+        return papers, encode_cursor({'rank': next_start})
+    return papers, None
+
+
+def fulfill_paper_query(db_session,
+                        tfidf,
+                        config,
+                        user,
+                        tab,
+                        time_filter,
+                        categories,
+                        affiliations,
+                        query_type,
+                        search_query,
+                        similar_id,
+                        offset,
+                        cursor=None):
+    """Returns a page of papers and the cursor of the next one. Search
+    results are paged by their rank, listings by (created, id) of the last
+    paper, so that later pages cost the same as the first. offset is used
+    for clients that do not pass cursor."""
 
     filter_conditions = []
 
@@ -110,48 +223,76 @@ def fulfill_paper_query(db_session, tfidf, config, user, tab, time_filter,
     else:
         affiliations = []
 
-    if tab == 'favorites' and user is not None:
+    is_search = search_query is not None and similar_id is None
+    is_similar = search_query is None and similar_id is not None
+    page_start = offset
+    last_paper = None
+    if cursor is not None:
+        try:
+            if is_search or is_similar:
+                page_start, = decode_cursor(cursor, ['rank'])
+                if not is_json_int(page_start) or page_start < 0:
+                    raise ValueError('Invalid rank')
+            else:
+                last_paper = decode_cursor(cursor, ['created', 'id'])
+                created, paper_id = last_paper
+                # values that do not fit the columns would fail the query
+                if (not is_json_int(created) or not -2**63 <= created < 2**63 or
+                        not isinstance(paper_id, str)):
+                    raise ValueError('Invalid last paper')
+        except (ValueError, TypeError):
+            return 'Invalid cursor', 400
+
+    is_favorites_tab = tab == 'favorites' and user is not None
+    if is_favorites_tab:
         db_query = (db_session.query(
             favorites_table,
             Paper.idx).filter(favorites_table.c.user_id == user.idx).join(
                 Paper, Paper.idx == favorites_table.c.paper_id))
     else:
-        db_query = paper_query = db_session.query(Paper.idx)
-
-    if search_query is not None and similar_id is None:
-        paper_filter_query = (db_query.filter(*filter_conditions).all())
+        db_query = db_session.query(Paper.idx)
 
-        filtered_ids = [paper[0] for paper in paper_filter_query]
+    if is_search:
+        if not is_favorites_tab and tfidf.supports_row_filters:
+            # the search index evaluates the filters on its own row metadata
+            filtered_ids = None
+        else:
+            paper_filter_query = (db_query.filter(*filter_conditions).all())
+            filtered_ids = [paper[0] for paper in paper_filter_query]
 
         sorted_ids = tfidf.search(search_query, time_filter, categories,
                                   affiliations, query_type, filtered_ids)
-        paper_query = (db_query.filter(
-            Paper.idx.in_(sorted_ids[offset:(
-                offset +
-                config.papers_per_request)])).with_entities(Paper).all())
-
-        paper_query.sort(key=lambda paper: sorted_ids.index(paper.idx))
+        paper_query, next_cursor = get_ranked_page(db_query, sorted_ids,
+                                                   page_start,
+                                                   config.papers_per_request)
 
-    elif search_query is None and similar_id is not None:
+    elif is_similar:
         sorted_ids = tfidf.search_similar(similar_id)
-        paper_query = (db_query.filter(*filter_conditions).filter(
-            Paper.idx.in_(sorted_ids[offset:(
-                offset +
-                config.papers_per_request)])).with_entities(Paper).all())
+        paper_query, next_cursor = get_ranked_page(
+            db_query.filter(*filter_conditions), sorted_ids, page_start,
+            config.papers_per_request)
     else:
-        paper_query = (db_query.filter(*filter_conditions).order_by(
-            Paper.created.desc()).limit(
-                config.papers_per_request).offset(offset).with_entities(Paper))
+        paper_query = db_query.filter(*filter_conditions)
+        if last_paper is not None:
+            paper_query = paper_query.filter(
+                tuple_(Paper.created, Paper.idx) < tuple_(*last_paper))
+        else:
+            paper_query = paper_query.offset(offset)
+        paper_query = (paper_query.order_by(
+            Paper.created.desc(), Paper.idx.desc()).limit(
+                config.papers_per_request).with_entities(Paper).all())
+
+        next_cursor = None
+        if len(paper_query) == config.papers_per_request:
+            next_cursor = encode_cursor({
+                'created': paper_query[-1].created,
+                'id': paper_query[-1].idx
+            })
 
-    if user is not None:
-        user_favorites = user.favorites
-    else:
-        user_favorites = None
     papers = {
-        'papers':
-            assemble_paper_dicts(paper_query, user_favorites=user_favorites),
-        'cutoff':
-            cutoff
+        'papers': assemble_paper_dicts(db_session, paper_query, user=user),
+        'cutoff': cutoff,
+        'next_cursor': next_cursor
     }
 
     return papers
@@ -226,70 +367,129 @@ class Paper(Base):
     created = Column('created', BigInteger)
     title = Column('title', String)
     abstract = Column('abstract', String)
-    authors = Column('authors', PickleType)
+    authors = Column('authors', JSONB)
     doi = Column('doi', String)
     journal_ref = Column('journal_ref', String)
-    primary_category = Column('primary_category', PickleType)
-    categories = Column('categories', PickleType)
-    versions = Column('versions', PickleType)
+    primary_category = Column('primary_category', String)
+    categories = Column('categories', ARRAY(String))
+    versions = Column('versions', JSONB)
     affiliations = relationship('Organization', secondary=affiliations_table)
 
-    def download_full_text(self, arxiv_base_url, full_text_dir):
-        id_and_version = self.idx + self.versions[-1]['version']
+    __table_args__ = (
+        # listings ordered by created and paged by (created, id)
+        Index('ix_papers_created_id', 'created', 'id'),
+        # listings filtered by category and ordered by created
+        Index('ix_papers_primary_category_created', 'primary_category',
+              'created'),
+        Index('ix_papers_categories', 'categories', postgresql_using='gin'),
+    )
+
+    def set_full_text_paths(self, full_text_dir):
         pdf_filename = paper_id_to_file_name(self.to_dict())
-        pdf_path = os.path.join(full_text_dir, pdf_filename)
+        self.pdf_path = os.path.join(full_text_dir, pdf_filename)
         pickle_filename = '.'.join(pdf_filename.split('.')[:-1]) + '.pkl'
         self.full_text_file_path = os.path.join(full_text_dir, pickle_filename)
 
-        if not os.path.exists(self.full_text_file_path):
-            download_paper(arxiv_base_url, id_and_version, pdf_path)
-            convert_pdf_to_text_pkl(os.path.join(full_text_dir, pdf_filename),
-                                    self.full_text_file_path)
-            os.remove(pdf_path)
-        return self.full_text_file_path
+    def download_pdf(self, arxiv_base_url, full_text_dir, rate_limiter=None):
+        """Downloads the pdf of the latest version unless its full text was
+        extracted before. Returns the pdf path or None if nothing was
+        downloaded."""
+        self.set_full_text_paths(full_text_dir)
+        if os.path.exists(self.full_text_file_path):
+            return None
+        id_and_version = self.idx + self.versions[-1]['version']
+        download_paper(arxiv_base_url,
+                       id_and_version,
+                       self.pdf_path,
+                       rate_limiter=rate_limiter)
+        return self.pdf_path
+
+    def to_dict(self, affiliation_ids=None):
+        """affiliation_ids, if given, replaces the lazy load of
+        self.affiliations."""
+        if affiliation_ids is None:
+            affiliation_ids = [
+                affiliation.idx for affiliation in self.affiliations
+            ]
+        return {
+            'id': self.idx,
+            'created': self.created,
+            'title': self.title,
+            'abstract': self.abstract,
+            'authors': self.authors,
+            'doi': self.doi,
+            'journal_ref': self.journal_ref,
+            'primary_category': self.primary_category,
+            'categories': self.categories,
+            'versions': self.versions,
+            'affiliations': affiliation_ids
+        }
 
-    def extract_affiliation(self, affiliations, full_text_file_path,
-                            db_session):
-        try:
-            with open(full_text_file_path, 'rb') as file:
-                papers_txt = pickle.load(file)
-        except Exception as e:
-            logger.error('Could not read {}'.format(full_text_file_path))
-            logger.error(e, exc_info=True)
-            return
 
-        for organization_name in extract_affiliations(papers_txt[0],
-                                                      affiliations):
-            organization = get_organization(db_session=db_session,
-                                            organization_id=organization_name)
-            self.affiliations.append(organization)
+def get_paper_row(paper):
+    return {
+        attribute.columns[0].name: getattr(paper, attribute.key)
+        for attribute in Paper.__mapper__.column_attrs
+    }
 
-    def to_dict(self):
-        return {
-            'id':
-                self.idx,
-            'created':
-                self.created,
-            'title':
-                self.title,
-            'abstract':
-                self.abstract,
-            'authors':
-                self.authors,
-            'doi':
-                self.doi,
-            'journal_ref':
-                self.journal_ref,
-            'primary_category':
-                self.primary_category,
-            'categories':
-                self.categories,
-            'versions':
-                self.versions,
-            'affiliations': [
-                affiliation.idx for affiliation in self.affiliations
+
+def upsert_papers(db_session, papers, batch_size):
+    """Inserts papers or updates the metadata of the ones that already
+    exist, with one INSERT ... ON CONFLICT DO UPDATE per batch_size papers.
+    The affiliations of papers with organization_ids, i.e. whose full text
+    was processed, are replaced by those organizations. Every batch is
+    committed on its own."""
+    paper_table = Paper.__table__
+    # a statement must not update the same row twice
+    papers = list({paper.idx: paper for paper in papers}.values())
+    organization_ids = {
+        organization[0] for organization in db_session.query(Organization.idx)
+    }
+
+    n_upserted = 0
+    for start in range(0, len(papers), batch_size):
+        batch = papers[start:start + batch_size]
+        statement = insert(paper_table).values(
+            [get_paper_row(paper) for paper in batch])
+        statement = statement.on_conflict_do_update(
+            index_elements=[paper_table.c.id],
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in paper_table.columns
+                if not column.primary_key
+            })
+
+        processed_ids = []
+        affiliation_rows = []
+        for paper in batch:
+            if not hasattr(paper, 'organization_ids'):
+                continue
+            processed_ids.append(paper.idx)
+            affiliation_rows += [
+                {
+                    'paper_id': paper.idx,
+                    'organization_id': organization_id
+                }
+                for organization_id in set(paper.organization_ids)
+                if organization_id in organization_ids
             ]
-        }
+        try:
+            db_session.execute(statement)
+            if processed_ids:
+                db_session.execute(affiliations_table.delete().where(
+                    affiliations_table.c.paper_id.in_(processed_ids)))
+            if affiliation_rows:
+                db_session.execute(
+                    affiliations_table.insert().values(affiliation_rows))
+            db_session.commit()
+        except exc.SQLAlchemyError as e:
+            logger.error('Could not upsert papers {} to {}'.format(
+                batch[0].idx, batch[-1].idx))
+            logger.error(e, exc_info=True)
+            db_session.rollback()
+            continue
+        n_upserted += len(batch)
+    return n_upserted
 
 
 def get_db_string(config):
@@ -298,7 +498,58 @@ def get_db_string(config):
     return db_string
 
 
-def create_db_session(db_string):
-    db_engine = create_engine(db_string, echo=True)
+# One engine, and with it one connection pool, per database and process
+db_engines = {}
+
+
+def get_db_engine(config):
+    db_string = get_db_string(config)
+    if db_string not in db_engines:
+        db_engine = create_engine(db_string,
+                                  echo=config.db_echo,
+                                  pool_size=config.db_pool_size,
+                                  max_overflow=config.db_max_overflow,
+                                  pool_pre_ping=config.db_pool_pre_ping,
+                                  pool_recycle=config.db_pool_recycle_sec)
+        event.listen(db_engine, 'connect', record_connection_pid)
+        event.listen(db_engine, 'checkout', check_connection_pid)
+        db_engines[db_string] = db_engine
+    return db_engines[db_string]
+
+
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def check_connection_pid(dbapi_connection, connection_record, connection_proxy):
+    # Pooled connections inherited from the parent process, e.g. when
+    # gunicorn forks its workers from a preloaded app or the fetcher forks
+    # its process pools, are dropped without being closed, which would
+    # terminate the parent's session on the shared socket. The pool then
+    # opens a new connection for this process.
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection record belongs to pid {}, attempting to check out in '
+            'pid {}'.format(connection_record.info['pid'], pid))
+
+
+def get_db_pool_status(db_engine):
+    pool = db_engine.pool
+    return {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow()
+    }
+
+
+def create_db_session(config):
+    db_engine = get_db_engine(config)
     Session = sessionmaker(db_engine)
     return Session(), db_engine
+
+
+def create_scoped_db_session(config):
+    return scoped_session(sessionmaker(get_db_engine(config)))
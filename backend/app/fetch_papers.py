@@ -1,17 +1,23 @@
 import os
-import requests
 import datetime
 import time
 import yaml
-import pickle
 import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import pytz
-import feedparser
 from sqlalchemy import exc
 
-from database import Base, Paper, Organization, create_db_session, get_db_string
-from utils import time_filter_to_unix_timestamp
+from database import (Base, Paper, Organization, create_db_session,
+                      upsert_papers)
+from full_text_manifest import FullTextManifest, parse_version
+from harvester import ArxivHarvester
+from metadata_store import MetadataStore
+from utils import RateLimiter, time_filter_to_unix_timestamp
+from paper_processing import (initialize_affiliation_matcher,
+                              process_paper_full_text)
 
 logger = logging.getLogger(__name__)
 
@@ -26,197 +32,167 @@ def convert_metadata_to_paper(metadata_dict):
                   journal_ref=metadata_dict['journal-ref'],
                   primary_category=metadata_dict['primary_category'],
                   categories=metadata_dict['categories'],
-                  versions=metadata_dict['versions'])
+                  versions=[
+                      dict(version, created=version['created'].timestamp())
+                      for version in metadata_dict['versions']
+                  ])
     return paper
 
 
-def update_database_with_last_days_papers(db_session, arxiv_base_url,
-                                          interesting_categories, affiliations,
-                                          save_metadata_dir,
-                                          save_full_text_dir):
+def persist_papers(metadata_dicts,
+                   db_session,
+                   arxiv_base_url,
+                   metadata_store,
+                   save_full_text_dir,
+                   processing_pool,
+                   download_workers=1,
+                   download_interval_sec=0,
+                   max_pending_papers=1,
+                   full_text_manifest_path=None,
+                   db_batch_size=1000):
+    """Saves the metadata of one harvested batch of papers, downloads and
+    processes their full texts and upserts them. Returns the (paper id,
+    full-text path) of the papers whose full text was extracted."""
+    if metadata_store is not None:
+        metadata_store.add(metadata_dicts)
 
-    timestamp_last_period = datetime.datetime.fromtimestamp(
-        time_filter_to_unix_timestamp('last_day'), tz=pytz.utc)
-
-    papers = fetch_recent_papers(categories=interesting_categories,
-                                 cutoff_timestamp=timestamp_last_period,
-                                 arxiv_base_url=arxiv_base_url,
-                                 affiliations=affiliations,
-                                 save_metadata_dir=save_metadata_dir,
-                                 save_full_text_dir=save_full_text_dir,
-                                 db_session=db_session)
-
-    paper_idx = 0
-    for current_paper in papers:
-        try:
-            existing_entry = db_session.query(Paper).filter(
-                Paper.idx == current_paper.idx).first()
-        except exc.SQLAlchemyError as e:
-            logger.error(e, exc_info=True)
-            time.sleep(10)
-            continue
-
-        if existing_entry:
-            existing_entry = current_paper
-            logger.info('{} already in database'.format(current_paper.idx))
-        else:
-            db_session.add(current_paper)
-        paper_idx += 1
-    db_session.commit()
-    logger.info('Done downloading papers.')
-
-
-def clean_title(title):
-    return title.replace('\n', ' ').replace('   ', ' ').replace('  ', ' ')
-
-
-def call_arxiv_api(arxiv_base_url,
-                   search_query,
-                   start,
-                   max_results,
-                   id_list=None,
-                   sort_by=None,
-                   sort_order=None):
-
-    assert (sort_order in ['ascending', 'descending', None])
-    assert (sort_by in ['relevance', 'lastUpdatedDate', 'submittedDate', None])
-
-    parameters = {
-        'search_query': search_query,
-        'start': str(start),
-        'max_results': str(max_results)
-    }
-
-    if id_list is not None:
-        parameters['id_list'] = id_list
-    if sort_by is not None:
-        parameters['sortBy'] = sort_by
-    if sort_order is not None:
-        parameters['sortOrder'] = sort_order
-
-    return requests.post(arxiv_base_url + '/api/query?', data=parameters)
-
-
-def convert_timestamps_to_datetime(entries):
-    for entry in entries:
-        entry['published'] = datetime.datetime.strptime(
-            entry['published'] + '+0000',
-            '%Y-%m-%dT%H:%M:%SZ%z').astimezone(pytz.utc)
-        entry['updated'] = datetime.datetime.strptime(
-            entry['updated'] + '+0000',
-            '%Y-%m-%dT%H:%M:%SZ%z').astimezone(pytz.utc)
-
-
-def convert_feedparser(feedparser_dict):
-    converted = {}
-    converted['id'] = feedparser_dict['id'].split('/')[-1].split('v')[0]
-    converted['created'] = feedparser_dict['updated']
-    converted['title'] = feedparser_dict['title']
-    converted['abstract'] = feedparser_dict['summary']
-    converted['authors'] = feedparser_dict['authors']
-    converted['journal-ref'] = feedparser_dict.get('arxiv_journal_ref', '')
-    converted['doi'] = feedparser_dict.get('arxiv_doi', '')
-    converted['categories'] = [
-        feedparser_dict['arxiv_primary_category']['term']
-    ] + [x['term'] for x in feedparser_dict['tags']]
-    converted['primary_category'] = converted['categories'][0]
-    converted['versions'] = [{
-        'version': 'v' + feedparser_dict['id'].split('/')[-1].split('v')[1],
-        'created': converted['created']
-    }]
-    return converted
-
-
-def fetch_recent_papers(categories,
-                        cutoff_timestamp,
-                        arxiv_base_url,
-                        affiliations=None,
-                        save_metadata_dir=None,
-                        save_full_text_dir=None,
-                        sleep_between_requests=0,
-                        verbose=False,
-                        db_session=None):
-    metadata_dicts = []
-    papers = []
-    n_batch = 1
-
-    logger.info('fetching all papers since {}'.format(cutoff_timestamp))
-    while True:
-        if verbose:
-            logger.info('Requesting batch {}'.format(n_batch))
-        search_query = 'cat:' + ' OR cat:'.join(categories)
-        result = call_arxiv_api(arxiv_base_url=arxiv_base_url,
-                                search_query=search_query,
-                                start=(n_batch - 1) * 100,
-                                max_results=100,
-                                sort_by='submittedDate',
-                                sort_order='descending')
-        parsed_feed = feedparser.parse(result.text)
-
-        # Check if a complete batch was returned else wait and try again
-        if len(parsed_feed['entries']) == 100:
-            n_batch += 1
-        else:
-            logger.info(
-                'Did not receive full batch. Rate limited? Status {}'.format(
-                    result.status_code))
-            time.sleep(sleep_between_requests)
-            continue
-
-        # Convert to metadata dictionary
-        convert_timestamps_to_datetime(parsed_feed['entries'])
-        new_metadata_dicts = [
-            convert_feedparser(entry)
-            for entry in parsed_feed['entries']
-            if entry['published'] > cutoff_timestamp
-        ]
-        metadata_dicts += new_metadata_dicts
-
-        # Save as pickle if save_metadata_dir is given
-        if save_metadata_dir is not None:
-            os.makedirs(save_metadata_dir, exist_ok=True)
-            for entry in new_metadata_dicts:
-                with open(
-                        os.path.join(save_metadata_dir,
-                                     entry['id'].split('/')[-1] + '.pkl'),
-                        'wb') as file:
-                    pickle.dump(entry, file)
-
-        # Break and return if cutoff reached
-        if parsed_feed['entries'][-1]['published'] < cutoff_timestamp:
-            break
-
-        if verbose:
-            logger.info('Current batch last timestamp {} and length {}'.format(
-                parsed_feed['entries'][-1]['published'],
-                len(parsed_feed['entries'])))
-
-        # Break and return if cutoff reached
-        if parsed_feed['entries'][-1]['published'] < cutoff_timestamp:
-            break
-
-        # Sleep between requests
-        time.sleep(sleep_between_requests)
-
-    logger.info('done fetching metadata.')
-
-    # Convert metadata to Paper instances
     papers = [
         convert_metadata_to_paper(metadata_dict)
         for metadata_dict in metadata_dicts
     ]
 
+    processed_papers = []
     if save_full_text_dir is not None:
         # Download and save full text and extract affiliations
         os.makedirs(save_full_text_dir, exist_ok=True)
         logger.info('Downloading {} papers.'.format(len(papers)))
-        for paper in papers:
-            full_text_file_path = paper.download_full_text(
-                arxiv_base_url, save_full_text_dir)
-            paper.extract_affiliation(affiliations, full_text_file_path,
-                                      db_session)
+        processed_papers = download_and_process_full_texts(
+            papers,
+            arxiv_base_url=arxiv_base_url,
+            save_full_text_dir=save_full_text_dir,
+            processing_pool=processing_pool,
+            download_workers=download_workers,
+            download_interval_sec=download_interval_sec,
+            max_pending_papers=max_pending_papers,
+            full_text_manifest_path=full_text_manifest_path)
+
+    n_upserted = upsert_papers(db_session, papers, db_batch_size)
+    logger.info('Upserted {}/{} papers.'.format(n_upserted, len(papers)))
+    return [(paper.idx, paper.full_text_file_path) for paper in processed_papers
+           ]
+
+
+def update_database_with_last_days_papers(db_session,
+                                          harvester,
+                                          arxiv_base_url,
+                                          interesting_categories,
+                                          metadata_store,
+                                          save_full_text_dir,
+                                          processing_pool,
+                                          download_workers=1,
+                                          download_interval_sec=0,
+                                          max_pending_papers=1,
+                                          full_text_manifest_path=None,
+                                          db_batch_size=1000):
+    """Harvests the papers of the last day with harvester and persists every
+    harvested batch while the next one is fetched. Returns the (paper id,
+    full-text path) of the papers whose full text was extracted."""
+    timestamp_last_period = datetime.datetime.fromtimestamp(
+        time_filter_to_unix_timestamp('last_day'), tz=pytz.utc)
+
+    logger.info('fetching all papers since {}'.format(timestamp_last_period))
+    persist_batch = functools.partial(
+        persist_papers,
+        db_session=db_session,
+        arxiv_base_url=arxiv_base_url,
+        metadata_store=metadata_store,
+        save_full_text_dir=save_full_text_dir,
+        processing_pool=processing_pool,
+        download_workers=download_workers,
+        download_interval_sec=download_interval_sec,
+        max_pending_papers=max_pending_papers,
+        full_text_manifest_path=full_text_manifest_path,
+        db_batch_size=db_batch_size)
+    fetched_documents = [
+        document for batch_documents in harvester.harvest(
+            interesting_categories, timestamp_last_period, persist_batch)
+        for document in batch_documents
+    ]
+    logger.info('Done downloading papers.')
+    return fetched_documents
+
+
+def create_processing_pool(affiliations, processing_workers):
+    """Returns the pool of processes for the text and affiliation extraction,
+    created once per harvest and shared by all of its batches, so that the
+    workers and their affiliation matchers are not set up again for every
+    page."""
+    return ProcessPoolExecutor(max_workers=processing_workers,
+                               initializer=initialize_affiliation_matcher,
+                               initargs=(affiliations,))
+
+
+def download_and_process_full_texts(papers,
+                                    arxiv_base_url,
+                                    save_full_text_dir,
+                                    processing_pool,
+                                    download_workers,
+                                    download_interval_sec,
+                                    max_pending_papers,
+                                    full_text_manifest_path=None):
+    """Downloads the pdfs with a rate limited pool of threads and hands each
+    one over to processing_pool for the text and affiliation extraction,
+    so that the cpu bound work overlaps with waiting for arXiv. At most
+    max_pending_papers are downloaded but not yet processed at any time.
+    Every extracted full text is recorded in the full-text manifest. Returns
+    the papers whose full text was extracted."""
+    rate_limiter = RateLimiter(download_interval_sec)
+    pending_papers = threading.BoundedSemaphore(max_pending_papers)
+    manifest = None
+    if full_text_manifest_path is not None:
+        manifest = FullTextManifest(full_text_manifest_path)
+
+    processed_papers = []
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+
+        def download_and_submit(paper):
+            pending_papers.acquire()
+            try:
+                pdf_path = paper.download_pdf(arxiv_base_url,
+                                              save_full_text_dir,
+                                              rate_limiter=rate_limiter)
+                processing_future = processing_pool.submit(
+                    process_paper_full_text, pdf_path,
+                    paper.full_text_file_path)
+            except Exception:
+                pending_papers.release()
+                raise
+            processing_future.add_done_callback(
+                lambda _: pending_papers.release())
+            return processing_future
+
+        download_futures = [
+            download_pool.submit(download_and_submit, paper) for paper in papers
+        ]
 
-    return papers
+        for paper, download_future in zip(papers, download_futures):
+            try:
+                organization_names = download_future.result().result()
+            except Exception as e:
+                logger.error('Could not process {}'.format(paper.idx))
+                logger.error(e, exc_info=True)
+                continue
+            # written to the database with the paper by upsert_papers
+            paper.organization_ids = organization_names
+            processed_papers.append(paper)
+            if manifest is not None:
+                manifest.record(paper.idx,
+                                parse_version(paper.versions[-1]['version']),
+                                paper.full_text_file_path)
+
+    if manifest is not None:
+        manifest.close()
+    return processed_papers
 
 
 def add_organization_to_database(db_session, organization):
@@ -237,8 +213,7 @@ def add_organization_to_database(db_session, organization):
 
 
 def initialize_tables(config):
-    db_string = get_db_string(config)
-    db_session, db_engine = create_db_session(db_string)
+    db_session, db_engine = create_db_session(config)
     tables_created = False
     while not tables_created:
         try:
@@ -253,21 +228,42 @@ def initialize_tables(config):
     for organization in affiliations:
         add_organization_to_database(db_session,
                                      Organization(idx=organization['name']))
-    return
+    db_session.close()
 
 
 def fetch_papers(config):
-    db_string = get_db_string(config)
-    session, _ = create_db_session(db_string)
+    session, _ = create_db_session(config)
 
     with open(config.affiliations_path) as file:
         affiliations = yaml.load(file, yaml.FullLoader)
 
     initialize_tables(config)
-    update_database_with_last_days_papers(
+    metadata_store = MetadataStore(config.metadata_store_dir)
+    processing_pool = create_processing_pool(affiliations,
+                                             config.processing_workers)
+    harvester = ArxivHarvester(
+        config.arxiv_base_url,
+        config.harvest_cursor_path,
+        config.harvest_request_interval_sec,
+        burst=config.harvest_burst,
+        max_retries=config.harvest_max_retries,
+        backoff_base_sec=config.harvest_backoff_base_sec,
+        backoff_max_sec=config.harvest_backoff_max_sec,
+        max_pending_batches=config.harvest_max_pending_batches)
+    fetched_documents = update_database_with_last_days_papers(
         db_session=session,
+        harvester=harvester,
         arxiv_base_url=config.arxiv_base_url,
         interesting_categories=config.categories,
-        affiliations=affiliations,
-        save_metadata_dir=config.metadata_dir,
-        save_full_text_dir=config.full_text_dir)
+        metadata_store=metadata_store,
+        save_full_text_dir=config.full_text_dir,
+        processing_pool=processing_pool,
+        download_workers=config.download_workers,
+        download_interval_sec=config.download_interval_sec,
+        max_pending_papers=config.max_pending_papers,
+        full_text_manifest_path=config.full_text_manifest_path,
+        db_batch_size=config.db_batch_size)
+    processing_pool.shutdown()
+    metadata_store.close()
+    session.close()
+    return fetched_documents
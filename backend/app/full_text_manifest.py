@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import logging
+
+from paper_processing import paper_id_to_file_name
+
+logger = logging.getLogger(__name__)
+
+
+def parse_version(version):
+    # arXiv versions are given as 'v1', 'v2', ...
+    return int(version.lstrip('v'))
+
+
+class FullTextManifest():
+    """sqlite table of the latest version of every paper whose full text was
+    extracted, with the path, size and mtime of the full-text file. Every
+    update is its own transaction, so the manifest matches the full-text
+    directory even if the fetcher stops in the middle of a run."""
+
+    def __init__(self, manifest_path):
+        os.makedirs(os.path.dirname(os.path.abspath(manifest_path)),
+                    exist_ok=True)
+        self.connection = sqlite3.connect(manifest_path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS full_texts (
+                    paper_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    file_path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL)''')
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM full_texts').fetchone()[0]
+
+    @property
+    def is_built(self):
+        """Whether the full texts extracted before the manifest existed were
+        recorded by build_from_metadata_store."""
+        return self.connection.execute('PRAGMA user_version').fetchone()[0] > 0
+
+    def record(self, paper_id, version, file_path):
+        self.record_many([(paper_id, version, file_path)])
+
+    def record_many(self, entries):
+        """Records (paper id, version, full-text path) entries in a single
+        transaction. An entry never replaces a newer version."""
+        rows = []
+        for paper_id, version, file_path in entries:
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                logger.error('Full text {} of {} does not exist'.format(
+                    file_path, paper_id))
+                continue
+            rows.append(
+                (paper_id, version, file_path, stat.st_size, stat.st_mtime))
+
+        with self.connection:
+            self.connection.executemany(
+                '''
+                INSERT INTO full_texts (paper_id, version, file_path, size,
+                                        mtime)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (paper_id) DO UPDATE SET
+                    version = excluded.version,
+                    file_path = excluded.file_path,
+                    size = excluded.size,
+                    mtime = excluded.mtime
+                WHERE excluded.version >= full_texts.version''', rows)
+
+    def get_documents(self):
+        """Returns the (paper id, full-text path) of all papers, ordered by
+        paper id."""
+        return self.connection.execute(
+            'SELECT paper_id, file_path FROM full_texts ORDER BY paper_id'
+        ).fetchall()
+
+    def build_from_metadata_store(self, full_text_dir, metadata_store):
+        """Fills the manifest from a scan of the metadata store and a single
+        listing of full_text_dir, for full texts extracted before the
+        manifest existed. The manifest only counts as built if the store
+        held any metadata, so that an empty store, e.g. one the old metadata
+        pickles were not packed into yet, is scanned again next time."""
+        logger.info('building full-text manifest from {}'.format(full_text_dir))
+        full_text_files = set(os.listdir(full_text_dir))
+        entries = []
+        n_scanned = 0
+        for metadata_dict in metadata_store.scan():
+            n_scanned += 1
+            pdf_filename = paper_id_to_file_name(metadata_dict)
+            pickle_basename_wo_version = pdf_filename.split('v')[0]
+            for version in range(9, 0, -1):
+                pickle_filename = pickle_basename_wo_version + 'v{}.pkl'.format(
+                    version)
+                if pickle_filename in full_text_files:
+                    entries.append((metadata_dict['id'], version,
+                                    os.path.join(full_text_dir,
+                                                 pickle_filename)))
+                    break
+        self.record_many(entries)
+        if n_scanned == 0:
+            logger.error('The metadata store is empty, the full-text manifest '
+                         'is not marked as built')
+            return
+        with self.connection:
+            self.connection.execute('PRAGMA user_version = 1')
+        logger.info('recorded {} full texts of {} papers'.format(
+            len(entries), n_scanned))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import random
+import asyncio
+import datetime
+import logging
+import xml.etree.ElementTree as ET
+
+import pytz
+import requests
+
+from arxiv_feed import parse_arxiv_feed
+
+logger = logging.getLogger(__name__)
+
+# submittedDate ranges of the arXiv API are given with minute precision
+ARXIV_DATE_FORMAT = '%Y%m%d%H%M'
+
+
+def clean_title(title):
+    return title.replace('\n', ' ').replace('   ', ' ').replace('  ', ' ')
+
+
+def call_arxiv_api(arxiv_base_url,
+                   search_query,
+                   start,
+                   max_results,
+                   id_list=None,
+                   sort_by=None,
+                   sort_order=None):
+
+    assert (sort_order in ['ascending', 'descending', None])
+    assert (sort_by in ['relevance', 'lastUpdatedDate', 'submittedDate', None])
+
+    parameters = {
+        'search_query': search_query,
+        'start': str(start),
+        'max_results': str(max_results)
+    }
+
+    if id_list is not None:
+        parameters['id_list'] = id_list
+    if sort_by is not None:
+        parameters['sortBy'] = sort_by
+    if sort_order is not None:
+        parameters['sortOrder'] = sort_order
+
+    return requests.post(arxiv_base_url + '/api/query?', data=parameters)
+
+
+def convert_feedparser(feedparser_dict):
+    converted = {}
+    converted['id'] = feedparser_dict['id'].split('/')[-1].split('v')[0]
+    converted['created'] = feedparser_dict['updated']
+    converted['title'] = feedparser_dict['title']
+    converted['abstract'] = feedparser_dict['summary']
+    converted['authors'] = feedparser_dict['authors']
+    converted['journal-ref'] = feedparser_dict.get('arxiv_journal_ref', '')
+    converted['doi'] = feedparser_dict.get('arxiv_doi', '')
+    converted['categories'] = [
+        feedparser_dict['arxiv_primary_category']['term']
+    ] + [x['term'] for x in feedparser_dict['tags']]
+    converted['primary_category'] = converted['categories'][0]
+    converted['versions'] = [{
+        'version': 'v' + feedparser_dict['id'].split('/')[-1].split('v')[1],
+        'created': converted['created']
+    }]
+    return converted
+
+
+def parse_arxiv_response(content):
+    """Returns the metadata dicts of the entries of an arXiv API response,
+    given as bytes, with their published timestamps, and the total number of
+    results of the query, or None if the response does not state it."""
+    entries, total_results = parse_arxiv_feed([content])
+    return ([
+        (entry['published'], convert_feedparser(entry)) for entry in entries
+    ], total_results)
+
+
+def get_backoff_delay(attempt, base_sec, max_sec):
+    """Exponential backoff with full jitter: a uniformly random delay of up
+    to base_sec * 2**attempt, capped at max_sec."""
+    return random.uniform(0, min(max_sec, base_sec * 2**attempt))
+
+
+class TokenBucket():
+    """Rate limit of on average rate acquisitions per second, of which up to
+    capacity may happen in a burst. Used from a single event loop."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HarvestCursor():
+    """Progress of the harvests, saved as json. Per search query it holds
+    harvested_until, the upper bound of the last completed submission time
+    window, and the window being harvested, if any, with the offset in it of
+    the first entry that was not persisted yet, so that an interrupted
+    harvest continues where it stopped."""
+
+    def __init__(self, cursor_path):
+        self.cursor_path = cursor_path
+        self.queries = {}
+        if os.path.exists(cursor_path):
+            with open(cursor_path) as file:
+                self.queries = json.load(file)
+
+    def get_harvested_until(self, search_query):
+        return self.queries.get(search_query, {}).get('harvested_until')
+
+    def get_window(self, search_query):
+        return self.queries.get(search_query, {}).get('window')
+
+    def set_window(self, search_query, lower, upper, start):
+        self.queries.setdefault(search_query, {})['window'] = {
+            'lower': lower,
+            'upper': upper,
+            'start': start
+        }
+        self._save()
+
+    def finish_window(self, search_query, upper):
+        progress = self.queries.setdefault(search_query, {})
+        progress.pop('window', None)
+        progress['harvested_until'] = max(
+            upper, progress.get('harvested_until', upper))
+        self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cursor_path)),
+                    exist_ok=True)
+        tmp_path = self.cursor_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.queries, file)
+        os.replace(tmp_path, self.cursor_path)
+
+
+class ArxivHarvester():
+    """Fetches the metadata of all papers of some categories submitted in a
+    time window from the arXiv API, newest first.
+
+    Requests are spaced out by a token bucket and retried with exponential
+    backoff when arXiv answers with an error or an incomplete page. Every
+    page is handed over to persist_batch through a bounded queue, so that the
+    next pages are fetched while a batch is persisted. The cursor only moves
+    past a page once persist_batch returned for it."""
+
+    def __init__(self,
+                 arxiv_base_url,
+                 cursor_path,
+                 request_interval_sec,
+                 burst=1,
+                 page_size=100,
+                 max_retries=8,
+                 backoff_base_sec=5,
+                 backoff_max_sec=300,
+                 max_pending_batches=2):
+        self.arxiv_base_url = arxiv_base_url
+        self.cursor = HarvestCursor(cursor_path)
+        self.request_interval_sec = request_interval_sec
+        self.burst = burst
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.max_pending_batches = max_pending_batches
+
+    def harvest(self, categories, cutoff_timestamp, persist_batch):
+        """Harvests the papers of categories submitted after
+        cutoff_timestamp, or after the end of the last completed harvest of
+        the same categories if that is earlier, after finishing an
+        interrupted one. persist_batch is called with the metadata dicts of
+        every page, from a worker thread, and the list of its return values
+        is returned."""
+        return asyncio.run(
+            self._harvest(categories, cutoff_timestamp, persist_batch))
+
+    async def _harvest(self, categories, cutoff_timestamp, persist_batch):
+        category_query = 'cat:' + ' OR cat:'.join(categories)
+        windows = []
+        harvested_until = self.cursor.get_harvested_until(category_query)
+        interrupted = self.cursor.get_window(category_query)
+        if interrupted is not None:
+            logger.info('resuming harvest of {} at {}'.format(
+                category_query, interrupted))
+            windows.append((interrupted['lower'], interrupted['upper'],
+                            interrupted['start']))
+            harvested_until = interrupted['upper']
+        # runs that were missed, e.g. while the fetcher was down, are caught
+        # up on by starting at the end of the last completed window
+        lower = int(cutoff_timestamp.timestamp())
+        if harvested_until is not None:
+            lower = min(harvested_until, lower)
+        windows.append((lower, int(time.time()), 0))
+
+        queue = asyncio.Queue(maxsize=self.max_pending_batches)
+        producer = asyncio.ensure_future(
+            self._fetch_windows(category_query, windows, queue))
+        consumer = asyncio.ensure_future(
+            self._persist_batches(category_query, queue, persist_batch))
+        try:
+            _, results = await asyncio.gather(producer, consumer)
+            return results
+        finally:
+            # a failure of either stage must not leave the other one waiting
+            producer.cancel()
+            consumer.cancel()
+
+    async def _fetch_windows(self, category_query, windows, queue):
+        rate_limiter = TokenBucket(1 / self.request_interval_sec, self.burst)
+        for lower, upper, start in windows:
+            await self._fetch_window(category_query, lower, upper, start,
+                                     rate_limiter, queue)
+        await queue.put(None)
+
+    async def _fetch_window(self, category_query, lower, upper, start,
+                            rate_limiter, queue):
+        search_query = '({}) AND submittedDate:[{} TO {}]'.format(
+            category_query, format_arxiv_date(lower), format_arxiv_date(upper))
+        while True:
+            entries, total_results = await self._fetch_page(
+                search_query, start, rate_limiter)
+            next_start = start + len(entries)
+            metadata_dicts = [
+                metadata_dict for published, metadata_dict in entries
+                if lower <= published.timestamp() <= upper
+            ]
+            is_last_page = next_start >= total_results
+            await queue.put(
+                (lower, upper, next_start, is_last_page, metadata_dicts))
+            logger.info('fetched {}/{} papers of window {} to {}'.format(
+                next_start, total_results, lower, upper))
+            if is_last_page:
+                return
+            start = next_start
+
+    async def _fetch_page(self, search_query, start, rate_limiter):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await rate_limiter.acquire()
+            try:
+                response = await loop.run_in_executor(
+                    None, lambda: call_arxiv_api(self.arxiv_base_url,
+                                                 search_query,
+                                                 start,
+                                                 self.page_size,
+                                                 sort_by='submittedDate',
+                                                 sort_order='descending'))
+                if response.status_code == 200:
+                    entries, total_results = await loop.run_in_executor(
+                        None, parse_arxiv_response, response.content)
+                    # arXiv sometimes answers with fewer entries than there
+                    # are left, which is only worth retrying
+                    if (total_results is not None and len(entries) == min(
+                            self.page_size, total_results - start)):
+                        return entries, total_results
+                logger.info('incomplete page at {}, status {}'.format(
+                    start, response.status_code))
+            except (requests.RequestException, ET.ParseError) as e:
+                # truncated or garbled responses are retried like errors
+                logger.error(e, exc_info=True)
+
+            delay = get_backoff_delay(attempt, self.backoff_base_sec,
+                                      self.backoff_max_sec)
+            logger.info('retrying in {:.1f}s'.format(delay))
+            await asyncio.sleep(delay)
+        raise RuntimeError(
+            'arXiv did not answer {} at {} after {} retries'.format(
+                search_query, start, self.max_retries))
+
+    async def _persist_batches(self, category_query, queue, persist_batch):
+        loop = asyncio.get_running_loop()
+        results = []
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                return results
+            lower, upper, next_start, is_last_page, metadata_dicts = batch
+            if metadata_dicts:
+                results.append(await
+                               loop.run_in_executor(None, persist_batch,
+                                                    metadata_dicts))
+            if is_last_page:
+                self.cursor.finish_window(category_query, upper)
+            else:
+                self.cursor.set_window(category_query, lower, upper, next_start)
+
+
+def format_arxiv_date(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, tz=pytz.utc).strftime(ARXIV_DATE_FORMAT)
@@ -0,0 +1,206 @@
+import os
+import json
+import shutil
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from constants import FilenameConstants as FC
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the on-disk layout written by save_index changes.
+INDEX_FORMAT_VERSION = 1
+
+
+def get_generation_dir_name(generation):
+    return 'generation-{:06d}'.format(generation)
+
+
+def get_generation_number(generation_dir):
+    return int(os.path.basename(generation_dir).split('-')[1])
+
+
+def list_generations(tfidf_dir):
+    generations = []
+    if not os.path.exists(tfidf_dir):
+        return generations
+    for dir_name in os.listdir(tfidf_dir):
+        if dir_name.startswith('generation-'):
+            try:
+                generations.append(int(dir_name.split('-')[1]))
+            except ValueError:
+                continue
+    return sorted(generations)
+
+
+def create_index_generation(tfidf_dir):
+    generations = list_generations(tfidf_dir)
+    generation = generations[-1] + 1 if generations else 1
+    generation_dir = os.path.join(tfidf_dir,
+                                  get_generation_dir_name(generation))
+    os.makedirs(generation_dir)
+    return generation_dir
+
+
+def publish_index_generation(tfidf_dir, generation_dir):
+    """Points CURRENT at generation_dir with an atomic rename, so readers
+    either see the complete old or the complete new generation."""
+    with open(os.path.join(generation_dir, FC.INDEX_METADATA), 'w') as file:
+        json.dump({'format_version': INDEX_FORMAT_VERSION}, file)
+
+    tmp_path = os.path.join(tfidf_dir, FC.CURRENT_INDEX + '.tmp')
+    with open(tmp_path, 'w') as file:
+        file.write(os.path.basename(generation_dir))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, os.path.join(tfidf_dir, FC.CURRENT_INDEX))
+    logger.info('published index generation {}'.format(generation_dir))
+
+
+def get_current_generation_dir(tfidf_dir):
+    current_path = os.path.join(tfidf_dir, FC.CURRENT_INDEX)
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path) as file:
+        return os.path.join(tfidf_dir, file.read().strip())
+
+
+def prune_index_generations(tfidf_dir, keep):
+    # Workers that still map an old generation keep reading it after the
+    # unlink, the pages are only released once they remap.
+    current_dir = get_current_generation_dir(tfidf_dir)
+    for generation in list_generations(tfidf_dir)[:-keep]:
+        generation_dir = os.path.join(tfidf_dir,
+                                      get_generation_dir_name(generation))
+        if generation_dir == current_dir:
+            continue
+        logger.info('removing index generation {}'.format(generation_dir))
+        shutil.rmtree(generation_dir, ignore_errors=True)
+
+
+def get_index_dtype(nnz):
+    return np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+
+
+def write_matrix_metadata(index_dir, layout, shape, nnz):
+    with open(os.path.join(index_dir, FC.MATRIX_METADATA), 'w') as file:
+        json.dump(
+            {
+                'format_version': INDEX_FORMAT_VERSION,
+                'layout': layout,
+                'shape': list(shape),
+                'nnz': int(nnz)
+            }, file)
+
+
+def save_sparse_arrays(index_dir, matrix):
+    os.makedirs(index_dir, exist_ok=True)
+    layout = 'csc' if sparse.isspmatrix_csc(matrix) else 'csr'
+    if layout == 'csr':
+        matrix = sparse.csr_matrix(matrix)
+    index_dtype = get_index_dtype(matrix.nnz)
+
+    np.save(os.path.join(index_dir, FC.SPARSE_DATA),
+            matrix.data.astype(np.float32, copy=False))
+    np.save(os.path.join(index_dir, FC.SPARSE_INDICES),
+            matrix.indices.astype(index_dtype, copy=False))
+    np.save(os.path.join(index_dir, FC.SPARSE_INDPTR),
+            matrix.indptr.astype(index_dtype, copy=False))
+    write_matrix_metadata(index_dir, layout, matrix.shape, matrix.nnz)
+
+
+def create_sparse_arrays(index_dir, n_major, nnz):
+    """Creates the data, indices and indptr files of a sparse matrix with
+    n_major rows (csr) or columns (csc) and nnz stored entries and maps them
+    writable, so that the matrix can be filled block by block without
+    holding it in memory. write_matrix_metadata completes the matrix."""
+    os.makedirs(index_dir, exist_ok=True)
+    index_dtype = get_index_dtype(nnz)
+    data = np.lib.format.open_memmap(os.path.join(index_dir, FC.SPARSE_DATA),
+                                     mode='w+',
+                                     dtype=np.float32,
+                                     shape=(nnz,))
+    indices = np.lib.format.open_memmap(os.path.join(index_dir,
+                                                     FC.SPARSE_INDICES),
+                                        mode='w+',
+                                        dtype=index_dtype,
+                                        shape=(nnz,))
+    indptr = np.lib.format.open_memmap(os.path.join(index_dir,
+                                                    FC.SPARSE_INDPTR),
+                                       mode='w+',
+                                       dtype=index_dtype,
+                                       shape=(n_major + 1,))
+    return data, indices, indptr
+
+
+def load_sparse_arrays(index_dir):
+    """Maps the sparse arrays of index_dir read-only, so that all processes
+    loading the same generation share one copy in the page cache."""
+    with open(os.path.join(index_dir, FC.MATRIX_METADATA)) as file:
+        matrix_metadata = json.load(file)
+
+    if matrix_metadata['format_version'] != INDEX_FORMAT_VERSION:
+        raise ValueError('Unsupported index format version {} in {}'.format(
+            matrix_metadata['format_version'], index_dir))
+
+    data = np.load(os.path.join(index_dir, FC.SPARSE_DATA), mmap_mode='r')
+    indices = np.load(os.path.join(index_dir, FC.SPARSE_INDICES), mmap_mode='r')
+    indptr = np.load(os.path.join(index_dir, FC.SPARSE_INDPTR), mmap_mode='r')
+
+    if matrix_metadata['layout'] == 'csc':
+        matrix_class = sparse.csc_matrix
+    else:
+        matrix_class = sparse.csr_matrix
+    return matrix_class((data, indices, indptr),
+                        shape=tuple(matrix_metadata['shape']),
+                        copy=False)
+
+
+def save_index(index_dir, matrix, ids):
+    save_sparse_arrays(index_dir, sparse.csr_matrix(matrix))
+    np.save(os.path.join(index_dir, FC.ROW_IDS), np.array(ids, dtype=str))
+
+
+def load_index(index_dir):
+    matrix = load_sparse_arrays(index_dir)
+    ids = np.load(os.path.join(index_dir, FC.ROW_IDS), mmap_mode='r')
+    return matrix, ids
+
+
+def get_paper_rows(ids):
+    """Returns the distinct paper ids of the rows of an index in which the
+    rows of a paper are consecutive, like the authors index, and the offsets
+    of their rows: the rows of paper_ids[n] are indptr[n]:indptr[n + 1]."""
+    ids = np.asarray(ids)
+    is_first_row = np.ones(len(ids), dtype=bool)
+    is_first_row[1:] = ids[1:] != ids[:-1]
+    starts = np.flatnonzero(is_first_row)
+    return ids[starts], np.append(starts, len(ids)).astype(np.int64)
+
+
+def save_paper_rows(index_dir, paper_ids, indptr):
+    np.save(os.path.join(index_dir, FC.PAPER_IDS), np.array(paper_ids,
+                                                            dtype=str))
+    np.save(os.path.join(index_dir, FC.PAPER_ROWS_INDPTR), indptr)
+
+
+def load_paper_rows(index_dir):
+    """Returns the paper ids and row offsets saved by save_paper_rows, or
+    None for an index without them."""
+    if not os.path.exists(os.path.join(index_dir, FC.PAPER_ROWS_INDPTR)):
+        return None
+    return (np.load(os.path.join(index_dir, FC.PAPER_IDS), mmap_mode='r'),
+            np.load(os.path.join(index_dir, FC.PAPER_ROWS_INDPTR),
+                    mmap_mode='r'))
+
+
+def save_postings(index_dir, matrix):
+    """Saves the column-oriented view of matrix, i.e. one posting list of
+    (row, weight) pairs per term."""
+    save_sparse_arrays(index_dir, sparse.csc_matrix(matrix))
+
+
+def load_postings(index_dir):
+    return load_sparse_arrays(index_dir)
@@ -0,0 +1,108 @@
+import os
+import json
+import pickle
+import datetime
+import logging
+
+import pytz
+
+from record_log import RecordLog
+
+logger = logging.getLogger(__name__)
+
+DATETIME_KEY = '$datetime'
+# pickles read before their metadata is appended to the store
+PICKLE_BATCH_SIZE = 1000
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {DATETIME_KEY: value.timestamp()}
+    raise TypeError('{} is not serializable'.format(type(value)))
+
+
+def decode_object(dictionary):
+    if DATETIME_KEY in dictionary:
+        return datetime.datetime.fromtimestamp(dictionary[DATETIME_KEY],
+                                               tz=pytz.utc)
+    return dictionary
+
+
+def serialize_metadata(metadata_dict):
+    # datetimes, i.e. the created timestamps, are stored as unix timestamps
+    return json.dumps(metadata_dict,
+                      default=encode_value,
+                      ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def deserialize_metadata(value):
+    return json.loads(value.decode('utf-8'), object_hook=decode_object)
+
+
+class MetadataStore():
+    """Metadata dicts of the harvested papers, stored as compact json in a
+    RecordLog keyed by paper id, instead of one pickle per paper. A paper
+    that is harvested again supersedes its older record. Appended records
+    are fsynced by add, the sorted index is rewritten by close."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.log = RecordLog(store_dir)
+
+    def __contains__(self, paper_id):
+        return paper_id in self.log
+
+    def __len__(self):
+        return len(self.log)
+
+    def get(self, paper_id):
+        value = self.log.get(paper_id)
+        if value is None:
+            return None
+        return deserialize_metadata(value)
+
+    def keys(self):
+        return self.log.keys()
+
+    def scan(self):
+        """Yields the metadata dicts of all papers, reading the segments
+        sequentially."""
+        for _, value in self.log.scan():
+            yield deserialize_metadata(value)
+
+    def add(self, metadata_dicts):
+        for metadata_dict in metadata_dicts:
+            self.log.append(metadata_dict['id'],
+                            serialize_metadata(metadata_dict))
+        self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+
+def pack_metadata_pickles(metadata_dir, metadata_store):
+    """Appends the metadata of the pickles in metadata_dir to metadata_store
+    and returns the paths of all pickles whose paper is stored."""
+    pickle_paths = []
+    batch = []
+    n_packed = 0
+    with os.scandir(metadata_dir) as directory_entries:
+        for directory_entry in directory_entries:
+            if not directory_entry.name.endswith('.pkl'):
+                continue
+            with open(directory_entry.path, 'rb') as file:
+                metadata_dict = pickle.load(file)
+            pickle_paths.append(directory_entry.path)
+            if metadata_dict['id'] in metadata_store:
+                continue
+            batch.append(metadata_dict)
+            if len(batch) == PICKLE_BATCH_SIZE:
+                metadata_store.add(batch)
+                n_packed += len(batch)
+                batch = []
+                logger.info('packed {} pickles'.format(n_packed))
+    metadata_store.add(batch)
+    n_packed += len(batch)
+    logger.info('packed {} of {} pickles'.format(n_packed, len(pickle_paths)))
+    return pickle_paths
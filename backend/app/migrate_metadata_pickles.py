@@ -0,0 +1,48 @@
+"""One-off packing of the per-paper metadata pickles in metadata_dir into the
+metadata store in metadata_store_dir. Papers that are already in the store,
+because they were packed by an interrupted run or harvested again since, are
+skipped, so the packing can be rerun. With --delete the pickles are removed
+once all of them are stored. Run it with CONFIG_PATH set while the paper
+fetcher is stopped:
+
+    CONFIG_PATH=/config/config.yaml python migrate_metadata_pickles.py
+"""
+import os
+import sys
+import argparse
+import logging
+
+from metadata_store import MetadataStore, pack_metadata_pickles
+from utils import Config
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_metadata_pickles(config, delete):
+    if not os.path.isdir(config.metadata_dir):
+        logger.info('{} does not exist'.format(config.metadata_dir))
+        return
+    metadata_store = MetadataStore(config.metadata_store_dir)
+    pickle_paths = pack_metadata_pickles(config.metadata_dir, metadata_store)
+    # writes the index, the records were fsynced by add
+    metadata_store.close()
+
+    if delete:
+        for pickle_path in pickle_paths:
+            os.remove(pickle_path)
+        logger.info('deleted {} pickles'.format(len(pickle_paths)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--delete',
+                        action='store_true',
+                        help='delete the pickles once they are packed')
+    args = parser.parse_args()
+
+    migrate_metadata_pickles(Config(os.getenv('CONFIG_PATH')), args.delete)
@@ -0,0 +1,137 @@
+"""One-off conversion of the pickled columns of the papers table of an existing
+database to text, text[] and jsonb, followed by the creation of the indexes
+declared in database.py. Run it once with CONFIG_PATH set while the backend and
+the paper fetcher are stopped:
+
+    CONFIG_PATH=/config/config.yaml python migrate_paper_columns.py
+"""
+import os
+import sys
+import pickle
+import datetime
+import logging
+
+from sqlalchemy import bindparam, inspect, text
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.types import String
+
+from database import Paper, affiliations_table, favorites_table, get_db_engine
+from utils import Config
+
+logger = logging.getLogger(__name__)
+
+# column -> new type, in the order of the SELECT of the pickled values
+CONVERTED_COLUMNS = {
+    'authors': JSONB(),
+    'primary_category': String(),
+    'categories': ARRAY(String),
+    'versions': JSONB()
+}
+
+
+def unpickle(value):
+    return pickle.loads(value) if value is not None else None
+
+
+def convert_version(version):
+    version = dict(version)
+    if isinstance(version.get('created'), datetime.datetime):
+        version['created'] = version['created'].timestamp()
+    return version
+
+
+def convert_row(authors, primary_category, categories, versions):
+    row = {'primary_category': unpickle(primary_category)}
+    authors = unpickle(authors)
+    row['authors'] = ([dict(author) for author in authors]
+                      if authors is not None else None)
+    categories = unpickle(categories)
+    row['categories'] = list(categories) if categories is not None else None
+    versions = unpickle(versions)
+    row['versions'] = ([convert_version(version) for version in versions]
+                       if versions is not None else None)
+    return row
+
+
+def get_pickled_columns(connection):
+    return [
+        column for column, in connection.execute(
+            text("SELECT column_name FROM information_schema.columns "
+                 "WHERE table_name = 'papers' AND data_type = 'bytea'"))
+        if column in CONVERTED_COLUMNS
+    ]
+
+
+def convert_pickled_columns(connection, batch_size):
+    for column, column_type in CONVERTED_COLUMNS.items():
+        connection.execute(
+            text('ALTER TABLE papers ADD COLUMN {}_converted {}'.format(
+                column, column_type.compile(dialect=connection.dialect))))
+
+    assignments = ', '.join(
+        '{0}_converted = :{0}'.format(column) for column in CONVERTED_COLUMNS)
+    update = text(
+        'UPDATE papers SET {} WHERE id = :id'.format(assignments)).bindparams(*[
+            bindparam(column, type_=column_type)
+            for column, column_type in CONVERTED_COLUMNS.items()
+        ])
+
+    # the pickled values are streamed through a server side cursor
+    rows = connection.execution_options(stream_results=True).execute(
+        text('SELECT id, ' + ', '.join(CONVERTED_COLUMNS) + ' FROM papers'))
+    n_converted = 0
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        connection.execute(
+            update, [dict(convert_row(*row[1:]), id=row[0]) for row in batch])
+        n_converted += len(batch)
+        logger.info('converted {} papers'.format(n_converted))
+
+    for column in CONVERTED_COLUMNS:
+        connection.execute(text('ALTER TABLE papers DROP COLUMN ' + column))
+        connection.execute(
+            text('ALTER TABLE papers RENAME COLUMN {0}_converted TO {0}'.format(
+                column)))
+
+
+def create_missing_indexes(connection):
+    inspector = inspect(connection)
+    for table in [Paper.__table__, affiliations_table, favorites_table]:
+        existing_indexes = {
+            index['name'] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                logger.info('creating index {}'.format(index.name))
+                index.create(connection)
+
+
+def migrate_paper_columns(config):
+    db_engine = get_db_engine(config)
+    # DDL is transactional in PostgreSQL, so a failed run changes nothing
+    with db_engine.begin() as connection:
+        pickled_columns = get_pickled_columns(connection)
+        if pickled_columns:
+            if len(pickled_columns) < len(CONVERTED_COLUMNS):
+                raise RuntimeError(
+                    'Only the columns {} of papers are pickled'.format(
+                        pickled_columns))
+            logger.info('converting pickled columns {}'.format(pickled_columns))
+            convert_pickled_columns(connection, config.db_batch_size)
+        else:
+            logger.info('papers has no pickled columns')
+        create_missing_indexes(connection)
+    with db_engine.connect() as connection:
+        connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+            text('ANALYZE papers'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        stream=sys.stdout,
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    migrate_paper_columns(Config(os.getenv('CONFIG_PATH')))
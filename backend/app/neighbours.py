@@ -0,0 +1,149 @@
+import os
+import logging
+
+import numpy as np
+
+from constants import FilenameConstants as FC
+from index_store import load_index
+
+logger = logging.getLogger(__name__)
+
+
+def select_top_k(positions, scores, k):
+    """Selects the k highest positive scores of each row. Returns an int32
+    position array and a float16 score array of shape (rows, k), padded with
+    -1 and 0 if a row has fewer than k positive scores."""
+    n_rows, n_candidates = scores.shape
+    top_positions = np.full((n_rows, k), -1, dtype=np.int32)
+    top_scores = np.zeros((n_rows, k), dtype=np.float16)
+    k_eff = min(k, n_candidates)
+    if k_eff == 0:
+        return top_positions, top_scores
+
+    top = np.argpartition(-scores, k_eff - 1, axis=1)[:, :k_eff]
+    candidate_scores = np.take_along_axis(scores, top, axis=1)
+    candidate_positions = np.take_along_axis(positions, top, axis=1)
+
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    candidate_scores = np.take_along_axis(candidate_scores, order, axis=1)
+    candidate_positions = np.take_along_axis(candidate_positions, order, axis=1)
+
+    is_positive = candidate_scores > 0
+    top_positions[:, :k_eff] = np.where(is_positive, candidate_positions, -1)
+    top_scores[:, :k_eff] = np.where(is_positive, candidate_scores, 0)
+    return top_positions, top_scores
+
+
+def compute_neighbours_full(transformed, rows, k, block_size):
+    n_papers = transformed.shape[0]
+    all_positions = np.arange(n_papers, dtype=np.int32)[np.newaxis, :]
+    # Converted once, scipy would otherwise convert it in every block product
+    transposed = transformed.transpose().tocsr()
+
+    positions = np.empty((len(rows), k), dtype=np.int32)
+    scores = np.empty((len(rows), k), dtype=np.float16)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        block_scores = (transformed[block_rows] @ transposed).toarray()
+        block_slice = slice(start, start + len(block_rows))
+        positions[block_slice], scores[block_slice] = select_top_k(
+            np.broadcast_to(all_positions, block_scores.shape), block_scores, k)
+    return positions, scores
+
+
+def merge_new_papers_into_neighbours(transformed, positions, scores, rows,
+                                     new_rows, k, block_size):
+    """Updates the neighbour lists of rows, which only cover the papers
+    indexed before, in place with the scores against new_rows."""
+    new_transposed = transformed[new_rows].transpose().tocsr()
+    new_positions = new_rows.astype(np.int32)[np.newaxis, :]
+
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        new_scores = (transformed[block_rows] @ new_transposed).toarray()
+        candidate_positions = np.hstack([
+            positions[block_rows],
+            np.broadcast_to(new_positions, new_scores.shape)
+        ])
+        candidate_scores = np.hstack(
+            [scores[block_rows].astype(np.float32), new_scores])
+        candidate_scores[candidate_positions < 0] = 0
+        positions[block_rows], scores[block_rows] = select_top_k(
+            candidate_positions, candidate_scores, k)
+
+
+def load_neighbours(generation_dir):
+    neighbours_dir = os.path.join(generation_dir, FC.NEIGHBOURS_INDEX)
+    if not os.path.exists(os.path.join(neighbours_dir, FC.NEIGHBOUR_POSITIONS)):
+        return None, None
+    positions = np.load(os.path.join(neighbours_dir, FC.NEIGHBOUR_POSITIONS),
+                        mmap_mode='r')
+    scores = np.load(os.path.join(neighbours_dir, FC.NEIGHBOUR_SCORES),
+                     mmap_mode='r')
+    return positions, scores
+
+
+def compute_nearest_neighbours(config,
+                               generation_dir,
+                               previous_generation_dir=None):
+    """Stores the similar_papers_k most similar papers of every row of the
+    papers index. If the previous generation has a table of the same width,
+    only the rows of papers that are new in this generation are computed
+    against the full corpus, while the old rows are carried over and merged
+    with the scores against the new papers."""
+    logger.info('computing nearest neighbours of papers')
+    k = config.similar_papers_k
+    block_size = config.neighbours_block_size
+
+    transformed, ids = load_index(os.path.join(generation_dir, FC.PAPERS_INDEX))
+    n_papers = transformed.shape[0]
+    id_to_pos = {paper_id: n for n, paper_id in enumerate(ids.tolist())}
+
+    previous_positions = None
+    if previous_generation_dir is not None:
+        try:
+            previous_positions, previous_scores = load_neighbours(
+                previous_generation_dir)
+            _, previous_ids = load_index(
+                os.path.join(previous_generation_dir, FC.PAPERS_INDEX))
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            previous_positions = None
+
+    if previous_positions is None or previous_positions.shape[1] != k:
+        logger.info('computing neighbours for all {} papers'.format(n_papers))
+        positions, scores = compute_neighbours_full(transformed,
+                                                    np.arange(n_papers), k,
+                                                    block_size)
+    else:
+        # Translate the positions of the previous generation into this one,
+        # papers that are no longer indexed map to -1.
+        previous_to_current = np.append(
+            np.fromiter((id_to_pos.get(paper_id, -1)
+                         for paper_id in previous_ids.tolist()),
+                        dtype=np.int32), -1)
+        old_rows = previous_to_current[:-1]
+        is_carried_over = old_rows >= 0
+        is_new = np.ones(n_papers, dtype=bool)
+        is_new[old_rows[is_carried_over]] = False
+        new_rows = np.flatnonzero(is_new)
+        logger.info('computing neighbours for {} new papers'.format(
+            len(new_rows)))
+
+        positions = np.full((n_papers, k), -1, dtype=np.int32)
+        scores = np.zeros((n_papers, k), dtype=np.float16)
+        positions[old_rows[is_carried_over]] = previous_to_current[
+            previous_positions[is_carried_over]]
+        scores[old_rows[is_carried_over]] = previous_scores[is_carried_over]
+
+        if len(new_rows) > 0:
+            positions[new_rows], scores[new_rows] = compute_neighbours_full(
+                transformed, new_rows, k, block_size)
+            merge_new_papers_into_neighbours(transformed, positions, scores,
+                                             np.flatnonzero(~is_new), new_rows,
+                                             k, block_size)
+
+    neighbours_dir = os.path.join(generation_dir, FC.NEIGHBOURS_INDEX)
+    os.makedirs(neighbours_dir, exist_ok=True)
+    np.save(os.path.join(neighbours_dir, FC.NEIGHBOUR_POSITIONS), positions)
+    np.save(os.path.join(neighbours_dir, FC.NEIGHBOUR_SCORES), scores)
@@ -8,7 +8,14 @@ import schedule
 
 import fetch_papers
 from utils import Config
-from tfidf import compute_tfidf_vectorization, compute_tfidf_vectorization_authors
+from tfidf import (compute_tfidf_vectorization,
+                   compute_tfidf_vectorization_authors,
+                   compute_tfidf_vectorization_chunked,
+                   compute_tfidf_vectorization_incremental)
+from neighbours import compute_nearest_neighbours
+from row_metadata import compute_row_metadata
+from index_store import (create_index_generation, get_current_generation_dir,
+                         publish_index_generation, prune_index_generations)
 
 
 def flush_tfidf_cache(config):
@@ -17,10 +24,35 @@ def flush_tfidf_cache(config):
 
 
 def run_paper_ingress():
-    fetch_papers.fetch_papers(config)
-    compute_tfidf_vectorization_authors(config)
-    compute_tfidf_vectorization(config)
+    global merge_thread
+    new_documents = fetch_papers.fetch_papers(config)
+    previous_generation_dir = get_current_generation_dir(config.tfidf_dir)
+    generation_dir = create_index_generation(config.tfidf_dir)
+    compute_tfidf_vectorization_authors(
+        config, generation_dir, [paper_id for paper_id, _ in new_documents])
+
+    if config.tfidf_mode == 'incremental':
+        if merge_thread is not None:
+            merge_thread.join()
+        segment_store = compute_tfidf_vectorization_incremental(
+            config, generation_dir, new_documents)
+    elif config.tfidf_mode == 'chunked':
+        segment_store = None
+        compute_tfidf_vectorization_chunked(config, generation_dir)
+    else:
+        segment_store = None
+        compute_tfidf_vectorization(config, generation_dir)
+
+    compute_row_metadata(config, generation_dir)
+    compute_nearest_neighbours(config, generation_dir, previous_generation_dir)
+    publish_index_generation(config.tfidf_dir, generation_dir)
     flush_tfidf_cache(config)
+    prune_index_generations(config.tfidf_dir,
+                            keep=config.index_generations_to_keep)
+
+    if segment_store is not None:
+        merge_thread = segment_store.merge_segments_in_background(
+            config.tfidf_max_segments)
 
 
 if __name__ == '__main__':
@@ -33,6 +65,7 @@ if __name__ == '__main__':
     logger = logging.getLogger(__name__)
 
     config = Config(os.getenv('CONFIG_PATH'))
+    merge_thread = None
 
     logger.info('Running initial papers fetch')
     run_paper_ingress()
@@ -4,8 +4,18 @@ import logging
 
 import pdftotext
 
+from affiliation_matcher import AffiliationMatcher
+
 logger = logging.getLogger(__name__)
 
+# Compiled once per processing worker by initialize_affiliation_matcher
+affiliation_matcher = None
+
+
+def initialize_affiliation_matcher(affiliations):
+    global affiliation_matcher
+    affiliation_matcher = AffiliationMatcher(affiliations)
+
 
 def paper_id_to_file_name(metadata_dict):
     version = metadata_dict['versions'][-1]['version']
@@ -28,3 +38,22 @@ def convert_pdf_to_text_pkl(paper_pdf_path, full_text_file_path):
 
     with open(full_text_file_path, 'wb') as file:
         pickle.dump(list(paper_pdf), file)
+
+
+def process_paper_full_text(paper_pdf_path, full_text_file_path):
+    """Converts a downloaded pdf to the full-text pickle, unless
+    paper_pdf_path is None, and returns the names of the organizations found
+    on the first page. Runs in a worker process of the processing pool."""
+    if paper_pdf_path is not None:
+        convert_pdf_to_text_pkl(paper_pdf_path, full_text_file_path)
+        os.remove(paper_pdf_path)
+
+    try:
+        with open(full_text_file_path, 'rb') as file:
+            papers_txt = pickle.load(file)
+    except Exception as e:
+        logger.error('Could not read {}'.format(full_text_file_path))
+        logger.error(e, exc_info=True)
+        return []
+
+    return affiliation_matcher.extract_affiliations(papers_txt[0])
@@ -0,0 +1,242 @@
+import os
+import json
+import zlib
+import struct
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# key length, value length and crc32 of the stored value
+RECORD_HEADER = struct.Struct('<HII')
+
+INDEX_KEYS = 'index_keys.npy'
+INDEX_POSITIONS = 'index_positions.npy'
+INDEX_METADATA = 'index.json'
+
+
+def get_segment_file_name(segment):
+    return 'segment-{:06d}.log'.format(segment)
+
+
+class RecordLog():
+    """Append-only log of (key, value) records, split into segment files of
+    at most max_segment_bytes.
+
+    Every record is length prefixed: key length, value length and crc32,
+    followed by the utf-8 key and the value, zlib compressed if compress is
+    set. A record for a key that was appended before supersedes the older
+    one. Keys are found through a sorted index of key -> (segment, offset),
+    which write_index saves next to the segments; records appended after the
+    last write_index are indexed in memory when the log is opened. Only one
+    process may append to a log at a time. Other processes open it with
+    read_only, which never modifies the files: a trailing record that is
+    still being written is then skipped instead of truncated."""
+
+    def __init__(self,
+                 log_dir,
+                 max_segment_bytes=2**30,
+                 compress=True,
+                 read_only=False):
+        self.log_dir = log_dir
+        self.max_segment_bytes = max_segment_bytes
+        self.compress = compress
+        self.read_only = read_only
+        if not read_only:
+            os.makedirs(log_dir, exist_ok=True)
+
+        # a read-only log that was never written to is empty
+        file_names = os.listdir(log_dir) if os.path.isdir(log_dir) else []
+        self.segments = sorted(
+            int(file_name.split('-')[1].split('.')[0])
+            for file_name in file_names
+            if file_name.startswith('segment-'))
+        self.file_descriptors = {}
+        self.write_file = None
+
+        metadata_path = os.path.join(log_dir, INDEX_METADATA)
+        if os.path.exists(metadata_path):
+            with open(metadata_path) as file:
+                indexed_until = json.load(file)['indexed_until']
+            self.index_keys = np.load(os.path.join(log_dir, INDEX_KEYS),
+                                      mmap_mode='r')
+            self.index_positions = np.load(os.path.join(log_dir,
+                                                        INDEX_POSITIONS),
+                                           mmap_mode='r')
+        else:
+            indexed_until = [0, 0]
+            self.index_keys = np.array([], dtype=str)
+            self.index_positions = np.zeros((0, 2), dtype=np.int64)
+
+        # key -> (segment, offset) of the records that are not indexed yet
+        self.tail = {}
+        self._index_tail(*indexed_until)
+
+    def _segment_path(self, segment):
+        return os.path.join(self.log_dir, get_segment_file_name(segment))
+
+    def _iter_segment(self, segment, offset=0):
+        """Yields (offset, key, value, record length) of the records of
+        segment from offset on, without decompressing the values. Stops at
+        a truncated or corrupt record."""
+        with open(self._segment_path(segment), 'rb') as file:
+            file.seek(offset)
+            while True:
+                header = file.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                key_length, value_length, crc = RECORD_HEADER.unpack(header)
+                body = file.read(key_length + value_length)
+                if (len(body) < key_length + value_length or
+                        zlib.crc32(body[key_length:]) != crc):
+                    return
+                record_length = RECORD_HEADER.size + len(body)
+                yield (offset, body[:key_length].decode('utf-8'),
+                       body[key_length:], record_length)
+                offset += record_length
+
+    def _index_tail(self, start_segment, start_offset):
+        for segment in self.segments:
+            if segment < start_segment:
+                continue
+            offset = start_offset if segment == start_segment else 0
+            end = offset
+            for offset, key, _, record_length in self._iter_segment(
+                    segment, offset):
+                self.tail[key] = (segment, offset)
+                end = offset + record_length
+
+            if (not self.read_only and segment == self.segments[-1] and
+                    end < os.path.getsize(self._segment_path(segment))):
+                # the last append was interrupted
+                logger.info('truncating incomplete record in {}'.format(
+                    self._segment_path(segment)))
+                os.truncate(self._segment_path(segment), end)
+
+    def _locate(self, key):
+        if key in self.tail:
+            return self.tail[key]
+        n = np.searchsorted(self.index_keys, key)
+        if n < len(self.index_keys) and self.index_keys[n] == key:
+            return tuple(self.index_positions[n])
+        return None
+
+    def __contains__(self, key):
+        return self._locate(key) is not None
+
+    def __len__(self):
+        n_reindexed = np.isin(list(self.tail), self.index_keys).sum()
+        return len(self.index_keys) + len(self.tail) - int(n_reindexed)
+
+    def _decode(self, value):
+        return zlib.decompress(value) if self.compress else value
+
+    def _read(self, segment, offset):
+        if self.write_file is not None:
+            self.write_file.flush()
+        if segment not in self.file_descriptors:
+            self.file_descriptors[segment] = os.open(
+                self._segment_path(segment), os.O_RDONLY)
+        file_descriptor = self.file_descriptors[segment]
+        key_length, value_length, _ = RECORD_HEADER.unpack(
+            os.pread(file_descriptor, RECORD_HEADER.size, offset))
+        value = os.pread(file_descriptor, value_length,
+                         offset + RECORD_HEADER.size + key_length)
+        return self._decode(value)
+
+    def get(self, key):
+        position = self._locate(key)
+        if position is None:
+            return None
+        return self._read(*position)
+
+    def keys(self):
+        return sorted(set(self.index_keys.tolist()) | set(self.tail))
+
+    def scan(self):
+        """Yields the (key, value) of all current records in the order they
+        were appended, reading the segments sequentially."""
+        for segment in self.segments:
+            for offset, key, value, _ in self._iter_segment(segment):
+                if self._locate(key) == (segment, offset):
+                    yield key, self._decode(value)
+
+    def append(self, key, value):
+        if self.read_only:
+            raise ValueError('{} is opened read-only'.format(self.log_dir))
+        key_bytes = key.encode('utf-8')
+        if self.compress:
+            value = zlib.compress(value)
+        record = RECORD_HEADER.pack(len(key_bytes), len(value),
+                                    zlib.crc32(value)) + key_bytes + value
+
+        if self.write_file is None:
+            self._open_segment(
+                is_new=not self.segments or
+                os.path.getsize(self._segment_path(self.segments[-1])) +
+                len(record) > self.max_segment_bytes)
+        elif (self.write_offset > 0 and
+              self.write_offset + len(record) > self.max_segment_bytes):
+            self._open_segment(is_new=True)
+        self.write_file.write(record)
+        self.tail[key] = (self.segments[-1], self.write_offset)
+        self.write_offset += len(record)
+
+    def _open_segment(self, is_new):
+        if self.write_file is not None:
+            self.write_file.close()
+        if is_new:
+            self.segments.append(self.segments[-1] + 1 if self.segments else 1)
+        segment_path = self._segment_path(self.segments[-1])
+        self.write_file = open(segment_path, 'ab')
+        self.write_offset = os.path.getsize(segment_path)
+
+    def flush(self):
+        if self.write_file is not None:
+            self.write_file.flush()
+            os.fsync(self.write_file.fileno())
+
+    def write_index(self):
+        """Merges the records appended since the last call into the sorted
+        index on disk."""
+        if self.read_only:
+            return
+        self.flush()
+        if not self.tail:
+            return
+        tail_keys = np.array(list(self.tail), dtype=str)
+        tail_positions = np.array(list(self.tail.values()), dtype=np.int64)
+        is_kept = ~np.isin(self.index_keys, tail_keys)
+        keys = np.concatenate([np.asarray(self.index_keys)[is_kept], tail_keys])
+        positions = np.concatenate(
+            [np.asarray(self.index_positions)[is_kept], tail_positions])
+        order = np.argsort(keys, kind='stable')
+        keys, positions = keys[order], positions[order]
+
+        for file_name, array in [(INDEX_KEYS, keys),
+                                 (INDEX_POSITIONS, positions)]:
+            tmp_path = os.path.join(self.log_dir, file_name + '.tmp.npy')
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(self.log_dir, file_name))
+
+        end = [
+            self.segments[-1],
+            os.path.getsize(self._segment_path(self.segments[-1]))
+        ]
+        tmp_path = os.path.join(self.log_dir, INDEX_METADATA + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump({'indexed_until': end}, file)
+        os.replace(tmp_path, os.path.join(self.log_dir, INDEX_METADATA))
+
+        self.index_keys, self.index_positions = keys, positions
+        self.tail = {}
+
+    def close(self):
+        self.write_index()
+        if self.write_file is not None:
+            self.write_file.close()
+            self.write_file = None
+        for file_descriptor in self.file_descriptors.values():
+            os.close(file_descriptor)
+        self.file_descriptors = {}
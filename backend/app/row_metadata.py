@@ -0,0 +1,124 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+from constants import FilenameConstants as FC
+from database import create_db_session, get_filter_metadata
+
+logger = logging.getLogger(__name__)
+
+
+class RowMetadata():
+    """Filter columns aligned with the rows of an index: the creation
+    timestamp, the primary category as a small integer code and one packed
+    bitset over the rows per organization."""
+
+    def __init__(self, created, category_codes, affiliation_bits,
+                 category_names, organization_names):
+        self.created = created
+        self.category_codes = category_codes
+        self.affiliation_bits = affiliation_bits
+        self.category_to_code = {
+            name: code for code, name in enumerate(category_names)
+        }
+        self.organization_to_bit_row = {
+            name: n for n, name in enumerate(organization_names)
+        }
+
+    @classmethod
+    def load(cls, index_dir):
+        labels_path = os.path.join(index_dir, FC.ROW_METADATA_LABELS)
+        if not os.path.exists(labels_path):
+            return None
+        with open(labels_path) as file:
+            labels = json.load(file)
+        created = np.load(os.path.join(index_dir, FC.ROW_CREATED),
+                          mmap_mode='r')
+        category_codes = np.load(os.path.join(index_dir, FC.ROW_CATEGORIES),
+                                 mmap_mode='r')
+        affiliation_bits = np.load(os.path.join(index_dir, FC.ROW_AFFILIATIONS),
+                                   mmap_mode='r')
+        return cls(created, category_codes, affiliation_bits,
+                   labels['categories'], labels['organizations'])
+
+    def filter_mask(self, cutoff, categories, affiliations):
+        mask = self.created > cutoff
+
+        if len(categories) > 0:
+            codes = [
+                self.category_to_code[category]
+                for category in categories
+                if category in self.category_to_code
+            ]
+            mask &= np.isin(self.category_codes, codes)
+
+        if len(affiliations) > 0:
+            bit_rows = [
+                self.organization_to_bit_row[organization]
+                for organization in affiliations
+                if organization in self.organization_to_bit_row
+            ]
+            packed = np.bitwise_or.reduce(self.affiliation_bits[bit_rows],
+                                          axis=0)
+            mask &= np.unpackbits(packed, count=len(mask)).astype(bool)
+
+        return mask
+
+
+def save_row_metadata(index_dir, ids, filter_metadata, organization_names):
+    n_rows = len(ids)
+    created = np.zeros(n_rows, dtype=np.int64)
+    category_codes = np.zeros(n_rows, dtype=np.int16)
+    affiliated_rows = [[] for _ in organization_names]
+
+    category_to_code = {}
+    organization_to_bit_row = {
+        name: n for n, name in enumerate(organization_names)
+    }
+    for row, paper_id in enumerate(ids):
+        if paper_id not in filter_metadata:
+            continue
+        paper_created, primary_category, organizations = filter_metadata[
+            paper_id]
+        created[row] = paper_created
+        category_codes[row] = category_to_code.setdefault(
+            primary_category, len(category_to_code))
+        for organization in organizations:
+            if organization in organization_to_bit_row:
+                affiliated_rows[organization_to_bit_row[organization]].append(
+                    row)
+
+    affiliation_bits = np.zeros((len(organization_names), (n_rows + 7) // 8),
+                                dtype=np.uint8)
+    for bit_row, rows in enumerate(affiliated_rows):
+        is_affiliated = np.zeros(n_rows, dtype=bool)
+        is_affiliated[rows] = True
+        affiliation_bits[bit_row] = np.packbits(is_affiliated)
+
+    np.save(os.path.join(index_dir, FC.ROW_CREATED), created)
+    np.save(os.path.join(index_dir, FC.ROW_CATEGORIES), category_codes)
+    np.save(os.path.join(index_dir, FC.ROW_AFFILIATIONS), affiliation_bits)
+    with open(os.path.join(index_dir, FC.ROW_METADATA_LABELS), 'w') as file:
+        json.dump(
+            {
+                'categories':
+                    sorted(category_to_code, key=category_to_code.get),
+                'organizations':
+                    organization_names
+            }, file)
+
+
+def compute_row_metadata(config, generation_dir):
+    logger.info('computing filter metadata of index rows')
+    db_session, _ = create_db_session(config)
+    filter_metadata, organization_names = get_filter_metadata(db_session)
+    db_session.close()
+
+    # the authors index is filtered by paper, not by author row
+    for index_name, ids_file_name in [(FC.PAPERS_INDEX, FC.ROW_IDS),
+                                      (FC.AUTHORS_INDEX, FC.PAPER_IDS)]:
+        index_dir = os.path.join(generation_dir, index_name)
+        ids = np.load(os.path.join(index_dir, ids_file_name)).tolist()
+        save_row_metadata(index_dir, ids, filter_metadata, organization_names)
@@ -1,117 +1,329 @@
 import os
+import time
 import pickle
-from collections import OrderedDict
 import logging
+import threading
 
 import numpy as np
+from scipy import sparse
 
 from constants import FilenameConstants as FC
+from index_store import (get_current_generation_dir, get_generation_number,
+                         get_paper_rows, load_index, load_paper_rows,
+                         load_postings)
+from neighbours import load_neighbours
+from row_metadata import RowMetadata
+from search_cache import create_search_cache
+from utils import time_filter_to_unix_timestamp
 
 logger = logging.getLogger('gunicorn.error')
 
 
+class SearchIndex():
+    """All arrays of one published index generation. An instance is not
+    modified after loading, so a request that holds a reference searches a
+    consistent generation even if a newer one is swapped in meanwhile. The
+    memory maps are released with the last reference."""
+
+    def __init__(self, config, generation_dir):
+        self.config = config
+        self.generation = get_generation_number(generation_dir)
+
+        logger.info('loading document vectors from {}'.format(generation_dir))
+        self.transformed, self.ids = load_index(
+            os.path.join(generation_dir, FC.PAPERS_INDEX))
+
+        with open(os.path.join(generation_dir, FC.TFIDF_PIPELINE_PAPERS),
+                  'rb') as file:
+            self.pipeline = pickle.load(file)
+
+        authors_index_dir = os.path.join(generation_dir, FC.AUTHORS_INDEX)
+        self.transformed_authors, self.ids_authors = load_index(
+            authors_index_dir)
+
+        with open(os.path.join(generation_dir, FC.TFIDF_PIPELINE_AUTHORS),
+                  'rb') as file:
+            self.pipeline_authors = pickle.load(file)
+
+        self.postings = None
+        postings_dir = os.path.join(generation_dir, FC.PAPERS_POSTINGS)
+        if config.search_engine == 'inverted_index':
+            if os.path.exists(postings_dir):
+                self.postings = load_postings(postings_dir)
+            else:
+                logger.info('no posting lists found, falling back to '
+                            'matrix search engine')
+
+        self.row_metadata = RowMetadata.load(
+            os.path.join(generation_dir, FC.PAPERS_INDEX))
+        # the rows of the authors index are grouped by paper: the author rows
+        # of author_paper_ids[n] are author_rows_indptr[n]:[n + 1]
+        paper_rows = load_paper_rows(authors_index_dir)
+        if paper_rows is not None:
+            self.author_paper_ids, self.author_rows_indptr = paper_rows
+            self.author_row_metadata = RowMetadata.load(authors_index_dir)
+        else:
+            # the row metadata of older generations is per author row
+            self.author_paper_ids, self.author_rows_indptr = get_paper_rows(
+                self.ids_authors)
+            self.author_row_metadata = None
+        self.author_row_papers = np.repeat(
+            np.arange(len(self.author_paper_ids)),
+            np.diff(self.author_rows_indptr))
+
+        self.neighbours, _ = load_neighbours(generation_dir)
+        if self.neighbours is None:
+            logger.info('no nearest neighbour table, similar papers are '
+                        'computed per request')
+
+        self.id_to_pos = {
+            paper_id: n for n, paper_id in enumerate(self.ids.tolist())
+        }
+        self.id_to_author_paper_pos = {
+            paper_id: n
+            for n, paper_id in enumerate(self.author_paper_ids.tolist())
+        }
+
+    @property
+    def supports_row_filters(self):
+        return (self.row_metadata is not None and
+                self.author_row_metadata is not None)
+
+    def get_positions(self, paper_ids, query_type):
+        """Positions of paper_ids in the papers index, or for author
+        queries in author_paper_ids."""
+        if query_type == 'author':
+            id_to_pos = self.id_to_author_paper_pos
+        else:
+            id_to_pos = self.id_to_pos
+        return np.fromiter((id_to_pos[paper_id]
+                            for paper_id in paper_ids
+                            if paper_id in id_to_pos),
+                           dtype=np.int64)
+
+    def get_filtered_positions(self, time_filter, categories, affiliations,
+                               query_type):
+        if query_type == 'author':
+            row_metadata = self.author_row_metadata
+        else:
+            row_metadata = self.row_metadata
+
+        cutoff = time_filter_to_unix_timestamp(
+            time_filter) if time_filter is not None else 0
+        return np.flatnonzero(
+            row_metadata.filter_mask(cutoff, categories, affiliations))
+
+    def search_similar(self, paper_id):
+        try:
+            paper_pos = self.id_to_pos[paper_id]
+        except KeyError:
+            return []
+
+        if self.neighbours is not None:
+            top_positions = self.neighbours[paper_pos]
+            top_positions = top_positions[top_positions >= 0]
+        else:
+            paper_vector = self.transformed[paper_pos]
+            scores = self.transformed.dot(paper_vector.transpose())
+            top_positions, _ = top_k_positions(scores,
+                                               self.config.max_search_results)
+        return self.ids[top_positions].tolist()
+
+    def search(self, query_string, query_type, filtered_positions):
+        if len(filtered_positions) == 0:
+            return []
+        if query_type == 'full_text':
+            return self._search_full_text(query_string, filtered_positions)
+        elif query_type == 'author':
+            return self._search_author(query_string, filtered_positions)
+        return []
+
+    def _search_author(self, query_string, filtered_positions):
+        """Scores the authors of the papers at filtered_positions of
+        author_paper_ids and ranks every paper by its best matching
+        author."""
+        query_vector = self.pipeline_authors.transform([query_string])
+        if len(filtered_positions) == len(self.author_paper_ids):
+            author_rows = np.arange(self.transformed_authors.shape[0])
+            scores = self.transformed_authors.dot(query_vector.transpose())
+        else:
+            author_rows = gather_rows(self.author_rows_indptr,
+                                      filtered_positions)
+            scores = self.transformed_authors[author_rows, :].dot(
+                query_vector.transpose())
+
+        positions, values = top_k_positions(scores)
+        # top_k_positions orders by score, so the first row of each paper
+        # is the one of its best matching author
+        paper_positions, first = np.unique(
+            self.author_row_papers[author_rows[positions]], return_index=True)
+        top_papers, _ = top_k_positions(values[first],
+                                        self.config.max_search_results)
+        return self.author_paper_ids[paper_positions[top_papers]].tolist()
+
+    def _search_full_text(self, query_string, filtered_positions):
+        query_vector = self.pipeline.transform([query_string])
+
+        if self.postings is not None:
+            top_positions = self._score_postings(query_vector,
+                                                 filtered_positions)
+        else:
+            scores = self.transformed[filtered_positions, :].dot(
+                query_vector.transpose())
+            top_positions = filtered_positions[top_k_positions(
+                scores, self.config.max_search_results)[0]]
+
+        return self.ids[top_positions].tolist()
+
+    def _score_postings(self, query_vector, filtered_positions):
+        """Accumulates the scores of the query terms over their posting lists
+        only, so that documents that contain none of the terms are never
+        touched."""
+        query_vector = query_vector.tocsr()
+        rows = []
+        contributions = []
+        for term, weight in zip(query_vector.indices, query_vector.data):
+            start = self.postings.indptr[term]
+            end = self.postings.indptr[term + 1]
+            rows.append(self.postings.indices[start:end])
+            contributions.append(self.postings.data[start:end] * weight)
+
+        if len(rows) == 0:
+            return np.array([], dtype=np.int64)
+        rows = np.concatenate(rows)
+        contributions = np.concatenate(contributions)
+
+        is_filtered = np.zeros(self.postings.shape[0], dtype=bool)
+        is_filtered[filtered_positions] = True
+        is_kept = is_filtered[rows]
+        candidates, candidate_rows = np.unique(rows[is_kept],
+                                               return_inverse=True)
+        scores = np.bincount(candidate_rows, weights=contributions[is_kept])
+
+        top_candidates, _ = top_k_positions(scores,
+                                            self.config.max_search_results)
+        return candidates[top_candidates]
+
+
 class TfidfSearch():
+    """Serves searches from the SearchIndex of the published generation.
 
-    def __init__(self, config):
+    A new generation is loaded next to the one in use, the cache is warmed
+    on it and it is then swapped in with a single reference assignment, so
+    requests are never served from a partially loaded index. Every worker
+    process polls the CURRENT pointer of the index store on its own."""
+
+    def __init__(self, config, saved_queries_loader=None):
 
         self.config = config
-        self.is_initialized = False
+        self.index = None
+        self.saved_queries_loader = saved_queries_loader
+        self.reload_lock = threading.Lock()
+        self.last_poll_time = time.time()
 
+        self.cache = create_search_cache(config)
         self.load_document_vectors()
-        self.cache = Queue(max_length=config.max_queries_cache)
+
+    @property
+    def is_initialized(self):
+        return self.index is not None
+
+    @property
+    def generation(self):
+        index = self.index
+        return index.generation if index is not None else 0
+
+    @property
+    def supports_row_filters(self):
+        index = self.index
+        return index is not None and index.supports_row_filters
 
     def load_document_vectors(self):
-        if not os.path.exists(self.config.tfidf_dir):
-            logger.info(
-                'tfidf_dir does not exist, setting is_initialized to False')
-            self.is_initialized = False
+        """Loads the published index generation if it is not the one in use
+        already. The results of the saved queries returned by
+        saved_queries_loader are cached before the new generation is swapped
+        in. If loading fails, the current generation stays in use."""
+        with self.reload_lock:
+            generation_dir = get_current_generation_dir(self.config.tfidf_dir)
+            if generation_dir is None:
+                logger.info('no published index generation')
+                return
+            if get_generation_number(generation_dir) == self.generation:
+                return
+
+            try:
+                index = SearchIndex(self.config, generation_dir)
+            except Exception as err:
+                logger.error(err, exc_info=True)
+                logger.error('loading of index generation {} failed, keeping '
+                             'generation {}'.format(generation_dir,
+                                                    self.generation))
+                return
+
+            if self.saved_queries_loader is not None:
+                try:
+                    self.warm_cache(index, self.saved_queries_loader())
+                except Exception as err:
+                    logger.error(err, exc_info=True)
+
+            self.index = index
+            logger.info('swapped in index generation {}'.format(
+                index.generation))
+            self.flush_cache()
+
+    def poll_index_generation(self):
+        """Reloads in a background thread if the CURRENT pointer names
+        another generation than the one in use. The pointer is read at most
+        every index_poll_interval_sec."""
+        now = time.time()
+        if now - self.last_poll_time < self.config.index_poll_interval_sec:
             return
+        self.last_poll_time = now
 
-        try:
-            if self.is_initialized:
-                logger.info('flushing current document vectors')
-                del self.transformed
-                del self.pipeline
-                del self.ids
-                del self.transformed_authors
-                del self.pipeline_authors
-                del self.ids_authors
-
-            self.is_initialized = False
-
-            logger.info('loading new document vectors')
-            with open(os.path.join(self.config.tfidf_dir, FC.VECTORIZED_PAPERS),
-                      'rb') as file:
-                self.transformed = pickle.load(file)
-
-            with open(
-                    os.path.join(self.config.tfidf_dir,
-                                 FC.TFIDF_PIPELINE_PAPERS), 'rb') as file:
-                self.pipeline = pickle.load(file)
-
-            with open(os.path.join(self.config.tfidf_dir, FC.PAPER_ID_MAP),
-                      'rb') as file:
-                self.ids = pickle.load(file)
-
-            with open(
-                    os.path.join(self.config.tfidf_dir, FC.VECTORIZED_AUTHORS),
-                    'rb') as file:
-                self.transformed_authors = pickle.load(file)
-
-            with open(
-                    os.path.join(self.config.tfidf_dir,
-                                 FC.TFIDF_PIPELINE_AUTHORS), 'rb') as file:
-                self.pipeline_authors = pickle.load(file)
-
-            with open(
-                    os.path.join(self.config.tfidf_dir,
-                                 FC.PAPER_ID_MAP_AUTHORS), 'rb') as file:
-                self.ids_authors = np.array(pickle.load(file))
-
-            self.id_to_pos = {self.ids[n]: n for n in range(len(self.ids))}
-            self.id_to_author_pos = {}
-            for n, paper_id in enumerate(self.ids_authors):
-                if paper_id in self.id_to_author_pos:
-                    self.id_to_author_pos[paper_id].append(n)
-                else:
-                    self.id_to_author_pos[paper_id] = [n]
-
-            {self.ids_authors[n]: n for n in range(len(self.ids_authors))}
-
-            self.is_initialized = True
-        except Exception as err:
-            logger.error(err, exc_info=True)
-            logger.error(
-                'loading of document vectors failed, setting is_initialized to False'
-            )
-            self.is_initialized = False
+        generation_dir = get_current_generation_dir(self.config.tfidf_dir)
+        if (generation_dir is None or
+                get_generation_number(generation_dir) == self.generation or
+                self.reload_lock.locked()):
+            return
+        threading.Thread(target=self.load_document_vectors, daemon=True).start()
 
     def flush_cache(self):
-        self.cache.data = OrderedDict()
+        # results are cached per index generation, so only the entries of
+        # other generations have to go
+        self.cache.invalidate(self.generation)
+
+    def warm_cache(self, index, saved_queries):
+        """Runs saved_queries on index in the given order until the time
+        budget cache_warming_budget_sec is used up."""
+        if not index.supports_row_filters:
+            return
+        start_time = time.time()
+        n_warmed = 0
+        for query in saved_queries:
+            if time.time() - start_time > self.config.cache_warming_budget_sec:
+                break
+            try:
+                self._cached_search(index, **query)
+                n_warmed += 1
+            except Exception as err:
+                logger.error('warming of query {} failed: {}'.format(
+                    query, err))
+        logger.info(
+            'warmed cache with {} of {} saved queries in {:.1f}s'.format(
+                n_warmed, len(saved_queries),
+                time.time() - start_time))
 
     def search_similar(self, paper_id):
-        if not self.is_initialized:
+        index = self.index
+        if index is None:
             return []
-        if (paper_id, 'similar') in self.cache:
-            return self.cache[(paper_id, 'similar')]
-        else:
-            try:
-                paper_pos = self.ids.index(paper_id)
-            except Exception as e:
-                return []
-
-            paper_vector = self.transformed[paper_pos]
-            scores = self.transformed.dot(paper_vector.transpose())
+        cached_ids = self.cache.get(index.generation, (paper_id, 'similar'))
+        if cached_ids is not None:
+            return cached_ids
 
-            sorted_scores = np.argsort(scores.todense().reshape(-1))
-            sorted_ids = []
-            for num in np.nditer(sorted_scores):
-                if scores[num] > 0.0:
-                    sorted_ids.append(self.ids[num])
-
-            sorted_ids.reverse()
-            self.cache.enqueue(((paper_id, 'similar'), sorted_ids))
-            return sorted_ids
+        sorted_ids = index.search_similar(paper_id)
+        self.cache.put(index.generation, (paper_id, 'similar'), sorted_ids)
+        return sorted_ids
 
     def search(self,
                query_string,
@@ -120,86 +332,69 @@ class TfidfSearch():
                affiliations,
                query_type='full_text',
                filtered_ids=None):
-        if not self.is_initialized or len(filtered_ids) == 0:
+        """Without filtered_ids, the time, category and affiliation filters
+        are evaluated on the row metadata of the index. Otherwise the search
+        is restricted to filtered_ids, which are expected to be filtered by
+        the caller already, and the result is not cached."""
+        index = self.index
+        if index is None:
             return []
-        cache_key = (query_string, query_type, time_filter, tuple(categories),
-                     tuple(affiliations))
-        if cache_key in self.cache:
-            logger.info('cache key {} found in cache'.format(cache_key))
-            return self.cache[cache_key]
-        else:
-            if query_type == 'full_text':
-                return self._search_full_text(query_string, cache_key,
-                                              filtered_ids)
-            elif query_type == 'author':
-                return self._search_author(query_string, cache_key,
-                                           filtered_ids)
 
-    def _search_author(self, query_string, cache_key, filtered_ids):
-
-        filtered_positions = []
-
-        for paper_id in filtered_ids:
-            filtered_positions += self.id_to_author_pos[paper_id]
-
-        filtered_positions = np.array(filtered_positions)
-        query_vector = self.pipeline_authors.transform([query_string])
-        scores = np.squeeze(
-            np.asarray((self.transformed_authors[filtered_positions, :].dot(
-                query_vector.transpose()).todense())))
-        sorted_scores = np.array(np.argsort((-1) * scores))
+        if filtered_ids is not None:
+            return index.search(query_string, query_type,
+                                index.get_positions(filtered_ids, query_type))
 
-        sorted_ids = list(self.ids_authors[filtered_positions[sorted_scores][
-            scores[sorted_scores] > 0]])
-        self.cache.enqueue((cache_key, sorted_ids))
-
-        return sorted_ids
-
-    def _search_full_text(self, query_string, cache_key, filtered_ids):
-        filtered_positions = [
-            self.id_to_pos[paper_id] for paper_id in filtered_ids
-        ]
-        query_vector = self.pipeline.transform([query_string])
-        scores = self.transformed[filtered_positions, :].dot(
-            query_vector.transpose())
-        sorted_scores = np.argsort((-1) * scores.todense().reshape(-1))
-        sorted_ids = []
-
-        for num in np.nditer(sorted_scores):
-            if scores[num] > 0.0:
-                sorted_ids.append(self.ids[filtered_positions[num]])
-            if len(sorted_ids) == self.config.max_search_results:
-                break
+        if not index.supports_row_filters:
+            return []
+        return self._cached_search(index, query_string, time_filter, categories,
+                                   affiliations, query_type)
+
+    def _cached_search(self, index, query_string, time_filter, categories,
+                       affiliations, query_type):
+        # the filters do not depend on the order in which they are given
+        cache_key = (query_string, query_type, time_filter,
+                     tuple(sorted(categories)), tuple(sorted(affiliations)))
+        cached_ids = self.cache.get(index.generation, cache_key)
+        if cached_ids is not None:
+            logger.info('cache key {} found in cache'.format(cache_key))
+            return cached_ids
 
-        self.cache.enqueue((cache_key, sorted_ids))
+        filtered_positions = index.get_filtered_positions(
+            time_filter, categories, affiliations, query_type)
+        sorted_ids = index.search(query_string, query_type, filtered_positions)
+        self.cache.put(index.generation, cache_key, sorted_ids)
         return sorted_ids
 
 
-class Queue:
-
-    def __init__(self, max_length):
-        self.data = OrderedDict()
-        self.max_length = max_length
-
-    def enqueue(self, item):
-        key, value = item
-        if key in self.data:
-            self.data.move_to_end(key)
-        self.data[key] = value
-        while len(self.data) > self.max_length:
-            self.dequeue()
-
-    def dequeue(self):
-        try:
-            return self.data.popitem(last=False)
-        except KeyError:
-            logger.error("Empty queue")
-
-    def __contains__(self, item):
-        return item in self.data
-
-    def __getitem__(self, key):
-        return self.data[key]
-
-    def __len__(self):
-        return len(self.data)
+def gather_rows(indptr, positions):
+    """Returns the concatenated rows indptr[n]:indptr[n + 1] of all n in
+    positions."""
+    starts = np.asarray(indptr[positions])
+    lengths = np.asarray(indptr[positions + 1]) - starts
+    # the offset that turns the position in the result into the row
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def top_k_positions(scores, k=None):
+    """Returns the positions and values of the k highest strictly positive
+    scores in descending order. scores is either a sparse (n, 1) result of a
+    matrix product, of which only the stored entries are considered, or a
+    dense 1d array. k=None returns all positive scores."""
+    if sparse.issparse(scores):
+        scores = scores.tocoo()
+        positions = scores.row if scores.shape[1] == 1 else scores.col
+        values = scores.data
+    else:
+        values = np.asarray(scores).ravel()
+        positions = np.arange(len(values))
+
+    is_positive = values > 0
+    positions, values = positions[is_positive], values[is_positive]
+
+    if k is not None and len(values) > k:
+        top = np.argpartition(-values, k - 1)[:k]
+        positions, values = positions[top], values[top]
+
+    order = np.argsort(-values, kind='stable')
+    return positions[order], values[order]
@@ -0,0 +1,250 @@
+import os
+import time
+import fcntl
+import pickle
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('gunicorn.error')
+
+# temporary files of puts older than this were left behind by a failed put
+STALE_TMP_SEC = 60
+
+
+class CacheStats():
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def to_dict(self):
+        return {
+            'pid': os.getpid(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class MemoryCache():
+    """Per-process LRU cache of search results, bounded by the pickled size
+    of the cached values. Keys are (index generation, cache key) pairs. Safe
+    to use from the threads of a worker."""
+
+    def __init__(self, max_bytes, ttl_sec):
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.data = OrderedDict()
+        self.n_bytes = 0
+        self.stats = CacheStats()
+        self.lock = threading.Lock()
+
+    def get(self, generation, key):
+        with self.lock:
+            entry = self.data.get((generation, key))
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove((generation, key))
+                self.stats.misses += 1
+                return None
+            self.data.move_to_end((generation, key))
+            self.stats.hits += 1
+            return entry[2]
+
+    def put(self, generation, key, value):
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if (generation, key) in self.data:
+                self._remove((generation, key))
+            self.data[(generation, key)] = (time.time() + self.ttl_sec, size,
+                                            value)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                self._remove(next(iter(self.data)))
+                self.stats.evictions += 1
+
+    def _remove(self, full_key):
+        _, size, _ = self.data.pop(full_key)
+        self.n_bytes -= size
+
+    def invalidate(self, generation):
+        """Drops all entries that were not computed on generation."""
+        with self.lock:
+            for full_key in list(self.data):
+                if full_key[0] != generation:
+                    self._remove(full_key)
+
+    def usage(self):
+        with self.lock:
+            return {'entries': len(self.data), 'bytes': self.n_bytes}
+
+
+class SharedFileCache():
+    """Cache of search results shared by all worker processes of a host.
+
+    Every entry is a pickle file in cache_dir, which should be on a tmpfs
+    such as /dev/shm so that the entries live in shared memory. Entries are
+    written to a temporary file and renamed, so readers never see partial
+    entries. The file modification time is refreshed on every hit.
+
+    The lock file holds a running total of the bytes in cache_dir and the
+    time of the last scan of the directory. Puts only add to the total under
+    an exclusive lock on it. The directory is scanned, the least recently
+    used and expired entries beyond max_bytes are removed and the total is
+    corrected only when it exceeds max_bytes or the last scan is older than
+    ttl_sec."""
+
+    def __init__(self, cache_dir, max_bytes, ttl_sec):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl_sec = ttl_sec
+        self.stats = CacheStats()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(cache_dir, '.lock')
+
+    def _entry_path(self, generation, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir,
+                            '{:06d}-{}.pkl'.format(generation, digest))
+
+    def get(self, generation, key):
+        entry_path = self._entry_path(generation, key)
+        try:
+            with open(entry_path, 'rb') as file:
+                stored_key, expires_at, value = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.stats.misses += 1
+            return None
+
+        if stored_key != key or expires_at < time.time():
+            self.stats.misses += 1
+            return None
+
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+        self.stats.hits += 1
+        return value
+
+    def put(self, generation, key, value):
+        entry = pickle.dumps((key, time.time() + self.ttl_sec, value),
+                             protocol=pickle.HIGHEST_PROTOCOL)
+        if len(entry) > self.max_bytes:
+            return
+        entry_path = self._entry_path(generation, key)
+        tmp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(),
+                                         threading.get_ident())
+        try:
+            try:
+                replaced_size = os.path.getsize(entry_path)
+            except OSError:
+                replaced_size = 0
+            with open(tmp_path, 'wb') as file:
+                file.write(entry)
+            os.replace(tmp_path, entry_path)
+            self._add_usage(len(entry) - replaced_size)
+        except OSError as e:
+            # e.g. a full tmpfs, which must not fail the search
+            logger.error('could not cache search result: {}'.format(e))
+            self._remove_file(tmp_path)
+
+    def _list_entries(self):
+        """Returns (mtime, size, file name) of the entries and removes the
+        temporary files that failed puts left behind."""
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            is_tmp = entry.name.endswith('.tmp')
+            if not is_tmp and not entry.name.endswith('.pkl'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if is_tmp:
+                if stat.st_mtime + STALE_TMP_SEC < now:
+                    self._remove_file(entry.path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.name))
+        return entries
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _remove_entry(self, file_name):
+        return self._remove_file(os.path.join(self.cache_dir, file_name))
+
+    def _add_usage(self, n_bytes):
+        with open(self.lock_path, 'a+') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            lock_file.seek(0)
+            try:
+                total_bytes, scanned_at = map(float, lock_file.read().split())
+            except ValueError:
+                # a new or invalidated cache, whose usage is unknown
+                total_bytes, scanned_at = 0, 0
+            total_bytes += n_bytes
+            now = time.time()
+            if total_bytes > self.max_bytes or scanned_at + self.ttl_sec < now:
+                total_bytes, scanned_at = self._evict(), now
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write('{} {}'.format(int(total_bytes), scanned_at))
+
+    def _evict(self):
+        """Removes expired and least recently used entries until at most
+        max_bytes are left and returns the bytes left. Called under the
+        lock."""
+        entries = sorted(self._list_entries())
+        n_bytes = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, file_name in entries:
+            if n_bytes <= self.max_bytes and mtime + self.ttl_sec > now:
+                break
+            if self._remove_entry(file_name):
+                n_bytes -= size
+                self.stats.evictions += 1
+        return n_bytes
+
+    def invalidate(self, generation):
+        """Removes all entries that were not computed on generation."""
+        prefix = '{:06d}-'.format(generation)
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # clearing the running total makes the next put scan the
+            # directory
+            lock_file.truncate(0)
+            n_removed = 0
+            for _, _, file_name in self._list_entries():
+                if not file_name.startswith(prefix):
+                    n_removed += self._remove_entry(file_name)
+        logger.info(
+            'removed {} cached results of other generations'.format(n_removed))
+
+    def usage(self):
+        entries = self._list_entries()
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries)
+        }
+
+
+def create_search_cache(config):
+    if config.search_cache == 'shared':
+        return SharedFileCache(config.search_cache_dir,
+                               max_bytes=config.search_cache_max_bytes,
+                               ttl_sec=config.search_cache_ttl_sec)
+    elif config.search_cache == 'memory':
+        return MemoryCache(max_bytes=config.search_cache_max_bytes,
+                           ttl_sec=config.search_cache_ttl_sec)
+    raise ValueError('unknown search_cache {}'.format(config.search_cache))
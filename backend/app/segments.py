@@ -0,0 +1,379 @@
+import os
+import json
+import shutil
+import logging
+import threading
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from constants import FilenameConstants as FC
+from index_store import (create_sparse_arrays, load_index, save_index,
+                         write_matrix_metadata)
+
+logger = logging.getLogger(__name__)
+
+
+def get_versioned_file_name(file_name, version):
+    root, extension = os.path.splitext(file_name)
+    return '{}-{:06d}{}'.format(root, version, extension)
+
+
+def compute_idf(document_frequencies, n_documents):
+    # Same smoothed idf as sklearn's TfidfTransformer(smooth_idf=True)
+    return (np.log(
+        (1 + n_documents) / (1 + document_frequencies)) + 1).astype(np.float32)
+
+
+def apply_tfidf_weighting(counts, idf):
+    """Sublinear tf, idf weighting and l2 normalisation of a block of raw
+    term counts, as done by TfidfTransformer(sublinear_tf=True)."""
+    weighted = sparse.csr_matrix(counts, dtype=np.float32, copy=True)
+    np.log(weighted.data, weighted.data)
+    weighted.data += 1
+    weighted.data *= idf[weighted.indices]
+    return normalize(weighted, norm='l2', copy=False)
+
+
+class SegmentStore():
+    """Append-only store of raw hashed term counts of the papers, split into
+    segments whose counts are never rewritten. Every segment holds the rows of
+    one ingest (or of a merge). Papers that are indexed again are only marked
+    deleted in their older segment. Document frequencies are maintained
+    incrementally, so that the idf weights can be recomputed without
+    touching the full texts.
+
+    Document frequencies and deletion masks are never overwritten either.
+    Every change writes them to new files of the next manifest version,
+    which the manifest references, so that the atomic replace of the
+    manifest commits the segments, frequencies and masks together.
+
+    n_features may grow between instances of a store, e.g. with the
+    vocabulary of the authors index. Older segments are then read as if they
+    had the new width."""
+
+    def __init__(self, store_dir, n_features):
+        self.store_dir = store_dir
+        self.n_features = n_features
+        self.lock = threading.Lock()
+        os.makedirs(store_dir, exist_ok=True)
+
+        # deletion masks that are not committed by a manifest yet
+        self.pending_deleted = {}
+        manifest_path = os.path.join(store_dir, FC.SEGMENTS_MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as file:
+                manifest = json.load(file)
+            self.segments = manifest['segments']
+            self.next_segment = manifest['next_segment']
+            self.n_documents = manifest['n_documents']
+            # stores written before the files were versioned use fixed names
+            self.version = manifest.get('version', 0)
+            self.frequencies_file = manifest.get('document_frequencies',
+                                                 FC.DOCUMENT_FREQUENCIES)
+            self.deleted_files = manifest.get('deleted_rows')
+            if self.deleted_files is None:
+                self.deleted_files = {
+                    segment: FC.DELETED_ROWS
+                    for segment in self.segments
+                    if os.path.exists(
+                        os.path.join(self._segment_dir(segment),
+                                     FC.DELETED_ROWS))
+                }
+            self.document_frequencies = np.load(
+                os.path.join(store_dir, self.frequencies_file))
+            self.set_n_features(n_features)
+            self._remove_uncommitted_files()
+        else:
+            self.segments = []
+            self.next_segment = 1
+            self.n_documents = 0
+            self.version = 0
+            self.frequencies_file = None
+            self.deleted_files = {}
+            self.document_frequencies = np.zeros(n_features, dtype=np.int64)
+
+        self.id_to_segment = {}
+        for segment in self.segments:
+            for paper_id in self._live_ids(segment):
+                self.id_to_segment[paper_id] = segment
+
+    def __len__(self):
+        return len(self.segments)
+
+    def set_n_features(self, n_features):
+        with self.lock:
+            self.document_frequencies = np.pad(
+                self.document_frequencies,
+                (0, n_features - len(self.document_frequencies)))
+            self.n_features = n_features
+
+    def __contains__(self, paper_id):
+        return paper_id in self.id_to_segment
+
+    def _segment_dir(self, segment):
+        return os.path.join(self.store_dir, segment)
+
+    def _load_segment(self, segment):
+        counts, ids = load_index(self._segment_dir(segment))
+        if counts.shape[1] < self.n_features:
+            counts = sparse.csr_matrix(
+                (counts.data, counts.indices, counts.indptr),
+                shape=(counts.shape[0], self.n_features),
+                copy=False)
+        if segment in self.pending_deleted:
+            is_deleted = self.pending_deleted[segment].copy()
+        elif segment in self.deleted_files:
+            is_deleted = np.load(
+                os.path.join(self._segment_dir(segment),
+                             self.deleted_files[segment]))
+        else:
+            is_deleted = np.zeros(len(ids), dtype=bool)
+        return counts, ids, is_deleted
+
+    def _live_ids(self, segment):
+        _, ids, is_deleted = self._load_segment(segment)
+        return ids[~is_deleted].tolist()
+
+    def _remove_uncommitted_files(self):
+        """Removes the versioned files of a manifest whose write was
+        interrupted."""
+        paths = [(self.store_dir, FC.DOCUMENT_FREQUENCIES,
+                  self.frequencies_file)]
+        for segment in self.segments:
+            paths.append((self._segment_dir(segment), FC.DELETED_ROWS,
+                          self.deleted_files.get(segment)))
+        for directory, file_name, committed_file in paths:
+            prefix = os.path.splitext(file_name)[0] + '-'
+            for other_file in os.listdir(directory):
+                if other_file.startswith(
+                        prefix) and other_file != committed_file:
+                    os.remove(os.path.join(directory, other_file))
+
+    def _write_manifest(self):
+        """Commits the segments, the document frequencies and the pending
+        deletion masks with a single replace of the manifest. The files of
+        the previous version are removed afterwards."""
+        self.version += 1
+        superseded = []
+        frequencies_file = get_versioned_file_name(FC.DOCUMENT_FREQUENCIES,
+                                                   self.version)
+        np.save(os.path.join(self.store_dir, frequencies_file),
+                self.document_frequencies)
+        if self.frequencies_file is not None:
+            superseded.append(
+                os.path.join(self.store_dir, self.frequencies_file))
+
+        deleted_files = {
+            segment: file_name
+            for segment, file_name in self.deleted_files.items()
+            if segment in self.segments
+        }
+        for segment, is_deleted in self.pending_deleted.items():
+            if segment not in self.segments:
+                continue
+            deleted_files[segment] = get_versioned_file_name(
+                FC.DELETED_ROWS, self.version)
+            np.save(
+                os.path.join(self._segment_dir(segment),
+                             deleted_files[segment]), is_deleted)
+            if segment in self.deleted_files:
+                superseded.append(
+                    os.path.join(self._segment_dir(segment),
+                                 self.deleted_files[segment]))
+
+        tmp_path = os.path.join(self.store_dir, FC.SEGMENTS_MANIFEST + '.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(
+                {
+                    'segments': self.segments,
+                    'next_segment': self.next_segment,
+                    'n_documents': self.n_documents,
+                    'version': self.version,
+                    'document_frequencies': frequencies_file,
+                    'deleted_rows': deleted_files
+                }, file)
+        os.replace(tmp_path, os.path.join(self.store_dir, FC.SEGMENTS_MANIFEST))
+
+        self.frequencies_file = frequencies_file
+        self.deleted_files = deleted_files
+        self.pending_deleted = {}
+        for path in superseded:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _new_segment_name(self):
+        segment = 'segment-{:06d}'.format(self.next_segment)
+        self.next_segment += 1
+        return segment
+
+    def _delete_documents(self, paper_ids):
+        rows_by_segment = {}
+        for paper_id in paper_ids:
+            if paper_id in self.id_to_segment:
+                rows_by_segment.setdefault(self.id_to_segment.pop(paper_id),
+                                           set()).add(paper_id)
+
+        for segment, deleted_ids in rows_by_segment.items():
+            counts, ids, is_deleted = self._load_segment(segment)
+            rows = np.flatnonzero(np.isin(ids, list(deleted_ids)) & ~is_deleted)
+            removed = counts[rows]
+            self.document_frequencies -= np.bincount(removed.indices,
+                                                     minlength=self.n_features)
+            self.n_documents -= len(rows)
+            is_deleted[rows] = True
+            # committed with the new segment by _write_manifest
+            self.pending_deleted[segment] = is_deleted
+
+    def add_documents(self, counts, ids, rows_per_id=False):
+        """Writes counts, the raw term counts of the papers ids, as a new
+        segment. Older rows of the same papers are marked deleted. With
+        rows_per_id a paper may have several consecutive rows, e.g. one per
+        author, which are all kept."""
+        if len(ids) == 0:
+            return
+        ids = np.array(ids, dtype=str)
+        if rows_per_id:
+            rows = np.arange(len(ids))
+        else:
+            # Only the last row of a paper that occurs several times is kept
+            _, last_rows = np.unique(ids[::-1], return_index=True)
+            rows = np.sort(len(ids) - 1 - last_rows)
+        ids = ids[rows].tolist()
+
+        with self.lock:
+            self._delete_documents(set(ids))
+
+            counts = sparse.csr_matrix(counts, dtype=np.float32)[rows]
+            counts.eliminate_zeros()
+            segment = self._new_segment_name()
+            save_index(self._segment_dir(segment), counts, ids)
+
+            self.document_frequencies += np.bincount(counts.indices,
+                                                     minlength=self.n_features)
+            self.n_documents += len(ids)
+            self.segments.append(segment)
+            for paper_id in ids:
+                self.id_to_segment[paper_id] = segment
+            self._write_manifest()
+            logger.info('added segment {} with {} documents'.format(
+                segment, len(ids)))
+
+    def idf(self):
+        return compute_idf(self.document_frequencies, self.n_documents)
+
+    def save_weighted_index(self, index_dir, postings_dir, block_size):
+        """Writes the tfidf weighted rows of all live documents to index_dir
+        and, unless postings_dir is None, their posting lists to
+        postings_dir. The rows are weighted and written block_size at a time
+        into preallocated memory-mapped arrays, whose sizes follow from the
+        document frequencies, so that neither matrix is ever held in
+        memory. Returns the ids of the rows and the
+        idf vector the weighting was done with."""
+        with self.lock:
+            idf = self.idf()
+            # every live count is a stored entry of one row and one column
+            nnz = int(self.document_frequencies.sum())
+            data, indices, indptr = create_sparse_arrays(
+                index_dir, self.n_documents, nnz)
+            arrays = [data, indices, indptr]
+            if postings_dir is not None:
+                postings_data, postings_indices, postings_indptr = (
+                    create_sparse_arrays(postings_dir, self.n_features, nnz))
+                postings_indptr[0] = 0
+                np.cumsum(self.document_frequencies, out=postings_indptr[1:])
+                next_posting = np.array(postings_indptr[:-1], dtype=np.int64)
+                all_terms = np.arange(self.n_features)
+                arrays += [postings_data, postings_indices, postings_indptr]
+
+            indptr[0] = 0
+            ids = []
+            n_rows = 0
+            for segment in self.segments:
+                counts, segment_ids, is_deleted = self._load_segment(segment)
+                live_rows = np.flatnonzero(~is_deleted)
+                for start in range(0, len(live_rows), block_size):
+                    block_rows = live_rows[start:start + block_size]
+                    weighted = apply_tfidf_weighting(counts[block_rows], idf)
+                    offset = indptr[n_rows]
+                    data[offset:offset + weighted.nnz] = weighted.data
+                    indices[offset:offset + weighted.nnz] = weighted.indices
+                    indptr[n_rows + 1:n_rows + len(block_rows) +
+                           1] = weighted.indptr[1:] + offset
+
+                    if postings_dir is not None:
+                        # the rows of a block come after those of all previous
+                        # blocks, so appending keeps every posting list sorted
+                        by_term = weighted.tocsc()
+                        term_counts = np.diff(by_term.indptr)
+                        terms = np.repeat(all_terms, term_counts)
+                        targets = next_posting[terms] + (
+                            np.arange(by_term.nnz) - by_term.indptr[terms])
+                        postings_data[targets] = by_term.data
+                        postings_indices[targets] = by_term.indices + n_rows
+                        next_posting += term_counts
+
+                    ids += segment_ids[block_rows].tolist()
+                    n_rows += len(block_rows)
+
+            for array in arrays:
+                array.flush()
+            write_matrix_metadata(index_dir, 'csr', (n_rows, self.n_features),
+                                  nnz)
+            if postings_dir is not None:
+                write_matrix_metadata(postings_dir, 'csc',
+                                      (n_rows, self.n_features), nnz)
+            np.save(os.path.join(index_dir, FC.ROW_IDS), np.array(ids,
+                                                                  dtype=str))
+
+        return ids, idf
+
+    def merge_segments(self, max_segments):
+        """Merges the smallest segments into one until at most max_segments
+        are left, dropping deleted rows on the way."""
+        with self.lock:
+            if len(self.segments) <= max_segments:
+                return
+            sizes = {
+                segment: len(self._live_ids(segment))
+                for segment in self.segments
+            }
+            to_merge = sorted(self.segments,
+                              key=sizes.get)[:len(self.segments) -
+                                             max_segments + 1]
+
+            blocks = []
+            merged_ids = []
+            for segment in self.segments:
+                if segment not in to_merge:
+                    continue
+                counts, ids, is_deleted = self._load_segment(segment)
+                live_rows = np.flatnonzero(~is_deleted)
+                blocks.append(counts[live_rows])
+                merged_ids += ids[live_rows].tolist()
+
+            merged_segment = self._new_segment_name()
+            save_index(self._segment_dir(merged_segment),
+                       sparse.vstack(blocks, format='csr'), merged_ids)
+
+            self.segments = [
+                segment for segment in self.segments if segment not in to_merge
+            ] + [merged_segment]
+            for paper_id in merged_ids:
+                self.id_to_segment[paper_id] = merged_segment
+            self._write_manifest()
+
+        for segment in to_merge:
+            shutil.rmtree(self._segment_dir(segment), ignore_errors=True)
+        logger.info('merged {} segments into {}'.format(len(to_merge),
+                                                        merged_segment))
+
+    def merge_segments_in_background(self, max_segments):
+        thread = threading.Thread(target=self.merge_segments,
+                                  args=(max_segments,),
+                                  daemon=True)
+        thread.start()
+        return thread
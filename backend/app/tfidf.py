@@ -1,45 +1,60 @@
 import os
 import re
 import pickle
+import shutil
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 from sklearn.feature_extraction.text import (TfidfTransformer, CountVectorizer,
                                              HashingVectorizer)
 from sklearn.pipeline import Pipeline
 import numpy as np
+from scipy import sparse
 
-from paper_processing import paper_id_to_file_name
-from database import Paper, create_db_session, get_db_string
+from database import Paper, create_db_session
 from constants import FilenameConstants as FC
+from index_store import (save_index, save_postings, get_paper_rows,
+                         save_paper_rows)
+from full_text_manifest import FullTextManifest
+from metadata_store import MetadataStore, pack_metadata_pickles
+from segments import SegmentStore
+from token_store import TokenStore, get_token_store_key
 
 logger = logging.getLogger(__name__)
 
+N_FEATURES = 2**20
+
 
 class FullTextDataset():
 
-    def __init__(self, full_text_dir, metadata_dir):
+    def __init__(self,
+                 full_text_dir,
+                 metadata_store_dir,
+                 manifest_path,
+                 metadata_dir=None):
         logger.info('loading full-text dataset')
-        metadata_file_paths = os.listdir(metadata_dir)
-        self.file_paths = []
-        self.ids = []
-
-        for metadata_file_path in metadata_file_paths:
-            with open(os.path.join(metadata_dir, metadata_file_path),
-                      'rb') as file:
-                metadata_dict = pickle.load(file)
-
-            pdf_filename = paper_id_to_file_name(metadata_dict)
-            pickle_basename_wo_version = pdf_filename.split('v')[0]
-
-            for version in range(1, 10):
-                pickle_filename = pickle_basename_wo_version + 'v{}.pkl'.format(
-                    version)
-                full_text_file_path = os.path.join(full_text_dir,
-                                                   pickle_filename)
-                if os.path.exists(full_text_file_path):
-                    self.file_paths.append(
-                        os.path.join(full_text_dir, pickle_filename))
-                    self.ids.append(metadata_dict['id'])
+        manifest = FullTextManifest(manifest_path)
+        if not manifest.is_built:
+            metadata_store = MetadataStore(metadata_store_dir)
+            if metadata_dir is not None and os.path.isdir(metadata_dir):
+                # metadata pickles of older versions that were not packed
+                # by migrate_metadata_pickles.py yet
+                pack_metadata_pickles(metadata_dir, metadata_store)
+            manifest.build_from_metadata_store(full_text_dir, metadata_store)
+            metadata_store.close()
+        documents = manifest.get_documents()
+        manifest.close()
+
+        self.ids = [paper_id for paper_id, _ in documents]
+        self.file_paths = [file_path for _, file_path in documents]
+
+    @classmethod
+    def from_documents(cls, documents):
+        dataset = cls.__new__(cls)
+        dataset.ids = [paper_id for paper_id, _ in documents]
+        dataset.file_paths = [file_path for _, file_path in documents]
+        return dataset
 
     def get_generator(self):
         counter = 0
@@ -47,96 +62,370 @@ class FullTextDataset():
             if counter % 1000 == 0:
                 logger.info('Processing {}/{}'.format(counter,
                                                       len(self.file_paths)))
-            try:
-                with open(file_path, 'rb') as file:
-                    paper_pdf = pickle.load(file)
-            except Exception as e:
-                logger.error('Could not read {}'.format(file_path))
-                logger.error(e, exc_info=True)
-                continue
-
-            raw_text = ' '.join(list(paper_pdf))
-            processed_text = re.sub(r'[^a-zA-Z0-9_\s]', '',
-                                    re.sub(r'\s+', ' ', raw_text)).lower()
             counter += 1
-            yield processed_text
-
-
-class AuthorsDataset():
-
-    def __init__(self, db_session):
-        self.db_query = db_session.query(Paper)
-        self.ids = []
-
-    def get_generator(self):
-        for paper in self.db_query:
-            for author in paper.authors:
-                self.ids.append(paper.idx)
-                processed_text = re.sub(r'[^a-zA-Z0-9_\s]', '',
-                                        re.sub(r'\s+', ' ',
-                                               author['name'])).lower()
-                yield processed_text
-
-
-def compute_tfidf_vectorization(config):
-    logger.info('computing tfidf vectorization for papers')
-    dataset = FullTextDataset(config.full_text_dir, config.metadata_dir)
-
-    pipeline = Pipeline([('hashvec',
-                          HashingVectorizer(decode_error='replace',
-                                            strip_accents='unicode',
-                                            lowercase=True,
-                                            stop_words='english',
-                                            ngram_range=(1, 1),
-                                            dtype=np.float32,
-                                            norm=None,
-                                            alternate_sign=False)),
-                         ('tfidf', TfidfTransformer(sublinear_tf=True))])
-
-    transformed = pipeline.fit_transform(dataset.get_generator())
-
-    with open(os.path.join(config.tfidf_dir, FC.VECTORIZED_PAPERS),
-              'wb') as file:
-        pickle.dump(transformed, file)
-
-    with open(os.path.join(config.tfidf_dir, FC.TFIDF_PIPELINE_PAPERS),
+            # unreadable full texts are empty rows, aligned with the ids
+            yield read_full_text(file_path) or ''
+
+    def get_count_chunks(self, chunk_size, n_workers=1, token_store=None):
+        """Yields (ids, raw term counts) of chunk_size papers at a time, in
+        the order of self.ids. With n_workers > 1 the chunks are read, cleaned
+        and hashed by a pool of processes, of which at most two chunks per
+        worker are pending. Papers found in token_store are counted from
+        their stored tokens, the tokens of all others are added to it."""
+        chunks = [(self.ids[start:start + chunk_size],
+                   self.file_paths[start:start + chunk_size])
+                  for start in range(0, len(self.ids), chunk_size)]
+        token_store_dir = token_store.store_dir if token_store else None
+
+        def add_to_token_store(new_tokens):
+            if token_store is not None and new_tokens:
+                for key, tokens in new_tokens:
+                    token_store.add(key, tokens)
+                token_store.flush()
+
+        if n_workers <= 1:
+            for n, (ids, file_paths) in enumerate(chunks):
+                logger.info('Hashing chunk {}/{}'.format(n + 1, len(chunks)))
+                counts, new_tokens = hash_full_texts(file_paths,
+                                                     token_store_dir)
+                add_to_token_store(new_tokens)
+                yield ids, counts
+            return
+
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            pending = deque()
+            for n, (ids, file_paths) in enumerate(chunks):
+                pending.append((ids,
+                                pool.submit(hash_full_texts, file_paths,
+                                            token_store_dir)))
+                if len(pending) >= 2 * n_workers:
+                    done_ids, done_future = pending.popleft()
+                    counts, new_tokens = done_future.result()
+                    add_to_token_store(new_tokens)
+                    yield done_ids, counts
+                logger.info('Hashing chunk {}/{}'.format(n + 1, len(chunks)))
+            while pending:
+                done_ids, done_future = pending.popleft()
+                counts, new_tokens = done_future.result()
+                add_to_token_store(new_tokens)
+                yield done_ids, counts
+
+
+def read_full_text(file_path):
+    """Returns the cleaned full text in file_path, or None if it cannot be
+    read."""
+    try:
+        with open(file_path, 'rb') as file:
+            paper_pdf = pickle.load(file)
+    except Exception as e:
+        logger.error('Could not read {}'.format(file_path))
+        logger.error(e, exc_info=True)
+        return None
+
+    raw_text = ' '.join(list(paper_pdf))
+    return re.sub(r'[^a-zA-Z0-9_\s]', '', re.sub(r'\s+', ' ', raw_text)).lower()
+
+
+def hash_full_texts(file_paths, token_store_dir=None):
+    """Returns the raw term counts of the full texts in file_paths and the
+    (key, tokens) of the papers that are not in the token store yet. Papers
+    in the token store are counted from their token ids, without reading
+    their full texts."""
+    hashing_vectorizer = build_hashing_vectorizer()
+    if token_store_dir is None:
+        return hashing_vectorizer.transform(
+            read_full_text(file_path) or '' for file_path in file_paths), []
+
+    # the main process appends to the store while the workers read it
+    token_store = TokenStore(token_store_dir, N_FEATURES, read_only=True)
+    analyzer = hashing_vectorizer.build_analyzer()
+    indices = []
+    data = []
+    new_tokens = []
+    for file_path in file_paths:
+        key = get_token_store_key(file_path)
+        token_ids = token_store.get_token_ids(key)
+        if token_ids is not None:
+            columns, column_counts = np.unique(
+                token_store.get_columns(token_ids), return_counts=True)
+        else:
+            text = read_full_text(file_path)
+            if text is None:
+                # an empty row, whose tokens are not stored, so that the
+                # paper is read again by the next index build
+                text = ''
+            else:
+                new_tokens.append((key, analyzer(text)))
+            row = hashing_vectorizer.transform([text])
+            row.sort_indices()
+            columns, column_counts = row.indices, row.data
+        indices.append(columns)
+        data.append(column_counts)
+
+    indptr = np.concatenate([[0], np.cumsum([len(row) for row in indices])])
+    counts = sparse.csr_matrix(
+        (np.concatenate(data + [np.zeros(0)]).astype(np.float32),
+         np.concatenate(indices + [np.zeros(0, dtype=np.int32)]), indptr),
+        shape=(len(file_paths), N_FEATURES))
+    return counts, new_tokens
+
+
+def clean_author_name(name):
+    return re.sub(r'[^a-zA-Z0-9_\s]', '', re.sub(r'\s+', ' ', name)).lower()
+
+
+def iter_paper_authors(db_session, batch_size, paper_ids=None):
+    """Yields the (id, authors) of all papers, or of paper_ids, streamed
+    batch_size rows at a time through a server side cursor instead of
+    loading Paper objects."""
+    query = db_session.query(Paper.idx, Paper.authors)
+    if paper_ids is None:
+        yield from query.yield_per(batch_size)
+        return
+    for start in range(0, len(paper_ids), batch_size):
+        yield from query.filter(
+            Paper.idx.in_(paper_ids[start:start + batch_size])).all()
+
+
+class AuthorVocabulary():
+    """Append-only vocabulary of the tokens of author names, stored one token
+    per line, so that token ids stay valid for the counts of earlier
+    papers."""
+
+    def __init__(self, vocabulary_path):
+        self.vocabulary_path = vocabulary_path
+        self.token_to_id = {}
+        if os.path.exists(vocabulary_path):
+            with open(vocabulary_path, encoding='utf-8') as file:
+                for token in file:
+                    self.token_to_id[token.rstrip('\n')] = len(self.token_to_id)
+        self.new_tokens = []
+
+    def __len__(self):
+        return len(self.token_to_id)
+
+    def get_token_ids(self, tokens):
+        token_ids = []
+        for token in tokens:
+            token_id = self.token_to_id.get(token)
+            if token_id is None:
+                token_id = len(self.token_to_id)
+                self.token_to_id[token] = token_id
+                self.new_tokens.append(token)
+            token_ids.append(token_id)
+        return token_ids
+
+    def flush(self):
+        if not self.new_tokens:
+            return
+        with open(self.vocabulary_path, 'a', encoding='utf-8') as file:
+            file.write(''.join(token + '\n' for token in self.new_tokens))
+            file.flush()
+            os.fsync(file.fileno())
+        self.new_tokens = []
+
+
+def add_authors_to_segments(store, vocabulary, paper_authors, chunk_size):
+    """Counts the tokens of every author of paper_authors, an iterable of
+    (paper id, authors), into one row per author and adds the rows of
+    chunk_size papers at a time as a segment of store."""
+    analyzer = build_author_count_vectorizer().build_analyzer()
+
+    def add_chunk(ids, indices, data, indptr):
+        # the vocabulary is written before the counts that refer to it
+        vocabulary.flush()
+        store.set_n_features(len(vocabulary))
+        counts = sparse.csr_matrix(
+            (np.array(data, dtype=np.float32), np.array(
+                indices, dtype=np.int64), np.array(indptr, dtype=np.int64)),
+            shape=(len(ids), len(vocabulary)))
+        store.add_documents(counts, ids, rows_per_id=True)
+
+    ids, indices, data, indptr = [], [], [], [0]
+    n_papers = 0
+    for paper_id, authors in paper_authors:
+        for author in authors or []:
+            token_ids = vocabulary.get_token_ids(
+                analyzer(clean_author_name(author['name'])))
+            columns, column_counts = np.unique(token_ids, return_counts=True)
+            ids.append(paper_id)
+            indices.extend(columns.tolist())
+            data.extend(column_counts.tolist())
+            indptr.append(len(indices))
+        n_papers += 1
+        if n_papers % chunk_size == 0:
+            logger.info('Counted authors of {} papers'.format(n_papers))
+            add_chunk(ids, indices, data, indptr)
+            ids, indices, data, indptr = [], [], [], [0]
+    add_chunk(ids, indices, data, indptr)
+
+
+def build_hashing_vectorizer():
+    return HashingVectorizer(decode_error='replace',
+                             strip_accents='unicode',
+                             lowercase=True,
+                             stop_words='english',
+                             ngram_range=(1, 1),
+                             n_features=N_FEATURES,
+                             dtype=np.float32,
+                             norm=None,
+                             alternate_sign=False)
+
+
+def build_author_count_vectorizer(vocabulary=None):
+    return CountVectorizer(decode_error='replace',
+                           strip_accents='unicode',
+                           lowercase=True,
+                           stop_words='english',
+                           ngram_range=(1, 1),
+                           dtype=np.float32,
+                           vocabulary=vocabulary)
+
+
+def build_fitted_pipeline(idf):
+    tfidf_transformer = TfidfTransformer(sublinear_tf=True)
+    tfidf_transformer.idf_ = idf
+    return Pipeline([('hashvec', build_hashing_vectorizer()),
+                     ('tfidf', tfidf_transformer)])
+
+
+def save_papers_pipeline(generation_dir, pipeline):
+    with open(os.path.join(generation_dir, FC.TFIDF_PIPELINE_PAPERS),
               'wb') as file:
         pickle.dump(pipeline, file)
 
-    with open(os.path.join(config.tfidf_dir, FC.PAPER_ID_MAP), 'wb') as file:
-        pickle.dump(dataset.ids, file)
 
+def save_papers_index(generation_dir, transformed, ids, pipeline):
+    save_index(os.path.join(generation_dir, FC.PAPERS_INDEX), transformed, ids)
+    save_postings(os.path.join(generation_dir, FC.PAPERS_POSTINGS), transformed)
+    save_papers_pipeline(generation_dir, pipeline)
 
-def compute_tfidf_vectorization_authors(config):
-    logger.info('computing tfidf vectorization for authors')
 
-    db_string = get_db_string(config)
-    db_session, _ = create_db_session(db_string)
+def get_token_store(config):
+    if config.token_store_dir is None:
+        return None
+    return TokenStore(config.token_store_dir, N_FEATURES)
 
-    dataset = AuthorsDataset(db_session)
 
-    pipeline = Pipeline([('hashvec',
-                          CountVectorizer(
-                              decode_error='replace',
-                              strip_accents='unicode',
-                              lowercase=True,
-                              stop_words='english',
-                              ngram_range=(1, 1),
-                              dtype=np.float32,
-                          )), ('tfidf', TfidfTransformer(sublinear_tf=True))])
+def add_dataset_to_segments(store, dataset, config):
+    """Hashes the documents of dataset tfidf_chunk_size at a time, every
+    chunk becomes one segment of store."""
+    for ids, counts in dataset.get_count_chunks(config.tfidf_chunk_size,
+                                                config.tfidf_workers,
+                                                get_token_store(config)):
+        store.add_documents(counts, ids)
 
-    transformed = pipeline.fit_transform(dataset.get_generator())
 
-    os.makedirs(config.tfidf_dir, exist_ok=True)
+def save_papers_index_from_segments(generation_dir, store, chunk_size):
+    _, idf = store.save_weighted_index(
+        os.path.join(generation_dir, FC.PAPERS_INDEX),
+        os.path.join(generation_dir, FC.PAPERS_POSTINGS), chunk_size)
+    save_papers_pipeline(generation_dir, build_fitted_pipeline(idf))
 
-    with open(os.path.join(config.tfidf_dir, FC.VECTORIZED_AUTHORS),
-              'wb') as file:
-        pickle.dump(transformed, file)
 
-    with open(os.path.join(config.tfidf_dir, FC.TFIDF_PIPELINE_AUTHORS),
+def compute_tfidf_vectorization(config, generation_dir):
+    logger.info('computing tfidf vectorization for papers')
+    dataset = FullTextDataset(config.full_text_dir,
+                              config.metadata_store_dir,
+                              config.full_text_manifest_path,
+                              metadata_dir=config.metadata_dir)
+
+    count_chunks = dataset.get_count_chunks(config.tfidf_chunk_size,
+                                            config.tfidf_workers,
+                                            get_token_store(config))
+    counts = sparse.vstack([counts for _, counts in count_chunks], format='csr')
+    # the hashing is stateless, so only the idf is fitted on the merged counts
+    tfidf_transformer = TfidfTransformer(sublinear_tf=True)
+    transformed = tfidf_transformer.fit_transform(counts)
+    pipeline = Pipeline([('hashvec', build_hashing_vectorizer()),
+                         ('tfidf', tfidf_transformer)])
+
+    save_papers_index(generation_dir, transformed, dataset.ids, pipeline)
+
+
+def compute_tfidf_vectorization_chunked(config, generation_dir):
+    """Same weighting as compute_tfidf_vectorization, but the raw counts of
+    tfidf_chunk_size papers at a time are written to a temporary segment
+    store and weighted from there into the index, so the peak memory is
+    bounded by the chunk size instead of the corpus size."""
+    logger.info('computing chunked tfidf vectorization for papers')
+    dataset = FullTextDataset(config.full_text_dir,
+                              config.metadata_store_dir,
+                              config.full_text_manifest_path,
+                              metadata_dir=config.metadata_dir)
+    chunks_dir = os.path.join(generation_dir, FC.CHUNKS_DIR)
+    store = SegmentStore(chunks_dir, N_FEATURES)
+
+    add_dataset_to_segments(store, dataset, config)
+    save_papers_index_from_segments(generation_dir, store,
+                                    config.tfidf_chunk_size)
+    shutil.rmtree(chunks_dir, ignore_errors=True)
+
+
+def compute_tfidf_vectorization_incremental(config, generation_dir,
+                                            new_documents):
+    """Hashes only new_documents, a list of (paper id, full-text path),
+    into new segments of the segment store and publishes the reweighted
+    rows of all segments. Only the very first run indexes all papers."""
+    logger.info('computing incremental tfidf vectorization for papers')
+    store = SegmentStore(os.path.join(config.tfidf_dir, FC.SEGMENTS_DIR),
+                         N_FEATURES)
+
+    if len(store) == 0:
+        logger.info('segment store is empty, indexing all papers')
+        dataset = FullTextDataset(config.full_text_dir,
+                                  config.metadata_store_dir,
+                                  config.full_text_manifest_path,
+                                  metadata_dir=config.metadata_dir)
+    else:
+        dataset = FullTextDataset.from_documents(new_documents)
+
+    add_dataset_to_segments(store, dataset, config)
+    save_papers_index_from_segments(generation_dir, store,
+                                    config.tfidf_chunk_size)
+    return store
+
+
+def compute_tfidf_vectorization_authors(config, generation_dir, paper_ids=None):
+    """Adds the authors of the papers that are not in the authors segment
+    store yet, and of paper_ids, to the store and publishes the reweighted
+    rows of all its segments. Only the very first run reads all papers."""
+    logger.info('computing tfidf vectorization for authors')
+    store_dir = os.path.join(config.tfidf_dir, FC.AUTHORS_SEGMENTS_DIR)
+    os.makedirs(store_dir, exist_ok=True)
+    vocabulary = AuthorVocabulary(os.path.join(store_dir, FC.TOKEN_VOCABULARY))
+    store = SegmentStore(store_dir, len(vocabulary))
+
+    db_session, _ = create_db_session(config)
+    if len(store) == 0:
+        logger.info('authors segment store is empty, indexing all papers')
+        new_paper_ids = None
+    else:
+        new_paper_ids = set(paper_ids or [])
+        new_paper_ids.update(paper_id for paper_id, in db_session.query(
+            Paper.idx).yield_per(config.db_batch_size) if paper_id not in store)
+        new_paper_ids = sorted(new_paper_ids)
+        logger.info('adding the authors of {} papers'.format(
+            len(new_paper_ids)))
+
+    add_authors_to_segments(
+        store, vocabulary,
+        iter_paper_authors(db_session, config.db_batch_size, new_paper_ids),
+        config.tfidf_chunk_size)
+    db_session.close()
+    store.merge_segments(config.tfidf_max_segments)
+
+    authors_index_dir = os.path.join(generation_dir, FC.AUTHORS_INDEX)
+    ids, idf = store.save_weighted_index(authors_index_dir, None,
+                                         config.tfidf_chunk_size)
+    save_paper_rows(authors_index_dir, *get_paper_rows(ids))
+
+    tfidf_transformer = TfidfTransformer(sublinear_tf=True)
+    tfidf_transformer.idf_ = idf
+    pipeline = Pipeline([
+        ('hashvec', build_author_count_vectorizer(vocabulary.token_to_id)),
+        ('tfidf', tfidf_transformer)
+    ])
+    with open(os.path.join(generation_dir, FC.TFIDF_PIPELINE_AUTHORS),
               'wb') as file:
         pickle.dump(pipeline, file)
-
-    with open(os.path.join(config.tfidf_dir, FC.PAPER_ID_MAP_AUTHORS),
-              'wb') as file:
-        pickle.dump(dataset.ids, file)
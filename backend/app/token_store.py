@@ -0,0 +1,129 @@
+import os
+import logging
+
+import numpy as np
+from sklearn.utils import murmurhash3_32
+
+from constants import FilenameConstants as FC
+from record_log import RecordLog
+
+logger = logging.getLogger(__name__)
+
+
+def get_token_store_key(full_text_file_path):
+    # the full-text file names are the paper id with its version
+    return os.path.splitext(os.path.basename(full_text_file_path))[0]
+
+
+def hash_token(token, n_features):
+    """Column of token in a HashingVectorizer with n_features and
+    alternate_sign=False."""
+    h = murmurhash3_32(token, seed=0)
+    if h == -2**31:
+        return (2**31 - 1 - (n_features - 1)) % n_features
+    return abs(h) % n_features
+
+
+class TokenStore():
+    """Cleaned and tokenized full texts, stored as arrays of token ids in a
+    RecordLog keyed by paper id and version.
+
+    Token ids index an append-only vocabulary. vocab_hash holds the column of
+    every token in the hashing vectorizer, so the raw term counts of a stored
+    paper follow from its token ids without opening, unpickling or
+    tokenizing its full text. New tokens and records are buffered until
+    flush, which writes the vocabulary before the records that use it. A
+    store opened read_only only serves get_token_ids and get_columns."""
+
+    def __init__(self, store_dir, n_features, read_only=False):
+        self.store_dir = store_dir
+        self.n_features = n_features
+        if not read_only:
+            os.makedirs(store_dir, exist_ok=True)
+        self.log = RecordLog(os.path.join(store_dir, FC.TOKEN_RECORDS),
+                             read_only=read_only)
+
+        vocab_hash_path = os.path.join(store_dir, FC.TOKEN_VOCABULARY_HASH)
+        if os.path.exists(vocab_hash_path):
+            self.vocab_hash = np.load(vocab_hash_path)
+        else:
+            self.vocab_hash = np.zeros(0, dtype=np.int32)
+
+        # the vocabulary itself is only needed to add papers
+        self.token_to_id = None
+        self.new_tokens = []
+        self.pending_records = []
+
+    def __contains__(self, key):
+        return key in self.log
+
+    def _load_vocabulary(self):
+        self.token_to_id = {}
+        vocabulary_path = os.path.join(self.store_dir, FC.TOKEN_VOCABULARY)
+        if os.path.exists(vocabulary_path):
+            with open(vocabulary_path, encoding='utf-8') as file:
+                for token in file:
+                    self.token_to_id[token.rstrip('\n')] = len(self.token_to_id)
+
+        if len(self.vocab_hash) < len(self.token_to_id):
+            # the vocabulary was written, but not its hashes
+            missing_tokens = list(self.token_to_id)[len(self.vocab_hash):]
+            self.vocab_hash = np.concatenate([
+                self.vocab_hash,
+                np.array([
+                    hash_token(token, self.n_features)
+                    for token in missing_tokens
+                ],
+                         dtype=np.int32)
+            ])
+
+    def get_token_ids(self, key):
+        value = self.log.get(key)
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.uint32)
+
+    def get_columns(self, token_ids):
+        return self.vocab_hash[token_ids]
+
+    def add(self, key, tokens):
+        if self.token_to_id is None:
+            self._load_vocabulary()
+        token_ids = np.empty(len(tokens), dtype=np.uint32)
+        for n, token in enumerate(tokens):
+            token_id = self.token_to_id.get(token)
+            if token_id is None:
+                token_id = len(self.token_to_id)
+                self.token_to_id[token] = token_id
+                self.new_tokens.append(token)
+            token_ids[n] = token_id
+        self.pending_records.append((key, token_ids.tobytes()))
+
+    def flush(self):
+        if self.new_tokens:
+            with open(os.path.join(self.store_dir, FC.TOKEN_VOCABULARY),
+                      'a',
+                      encoding='utf-8') as file:
+                file.write(''.join(token + '\n' for token in self.new_tokens))
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.vocab_hash = np.concatenate([
+                self.vocab_hash,
+                np.array([
+                    hash_token(token, self.n_features)
+                    for token in self.new_tokens
+                ],
+                         dtype=np.int32)
+            ])
+            tmp_path = os.path.join(self.store_dir,
+                                    FC.TOKEN_VOCABULARY_HASH + '.tmp.npy')
+            np.save(tmp_path, self.vocab_hash)
+            os.replace(tmp_path,
+                       os.path.join(self.store_dir, FC.TOKEN_VOCABULARY_HASH))
+            self.new_tokens = []
+
+        for key, value in self.pending_records:
+            self.log.append(key, value)
+        self.pending_records = []
+        self.log.write_index()
@@ -1,12 +1,14 @@
 import requests
 import os
+import json
+import base64
 import time
 import datetime
 import logging
+import threading
 
 import yaml
 import pytz
-from fuzzysearch import find_near_matches
 
 logger = logging.getLogger(__name__)
 
@@ -84,6 +86,22 @@ def time_filter_to_unix_timestamp(filter_string):
     return int(submission_period_start.timestamp())
 
 
+def encode_cursor(values):
+    """Encodes a dict of json values as an opaque, url safe page cursor."""
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor, fields):
+    """Returns the values of fields of an encoded page cursor. Raises a
+    ValueError if it is malformed or lacks one of fields."""
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not isinstance(values, dict) or not all(field in values
+                                               for field in fields):
+        raise ValueError('Invalid cursor')
+    return [values[field] for field in fields]
+
+
 class Config:
 
     def __init__(self, config_path):
@@ -98,11 +116,30 @@ def download_papers(arxiv_base_url, paper_ids, paper_dir):
             download_paper(arxiv_base_url, paper_id, paper_dir)
 
 
-def download_paper(arxiv_base_url, paper_id, pdf_path):
+class RateLimiter():
+    """Spaces out calls to wait() from any number of threads by at least
+    min_interval seconds."""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = max(0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.min_interval
+        time.sleep(wait_time)
+
+
+def download_paper(arxiv_base_url, paper_id, pdf_path, rate_limiter=None):
     pdf_url = arxiv_base_url + '/pdf/' + paper_id + '.pdf'
 
     is_downloaded = False
     while not is_downloaded:
+        if rate_limiter is not None:
+            rate_limiter.wait()
         try:
             resp = requests.get(pdf_url)
             is_downloaded = True
@@ -112,21 +149,3 @@ def download_paper(arxiv_base_url, paper_id, pdf_path):
     with open(pdf_path, 'wb') as file:
         file.write(resp.content)
     logger.info('downloaded {}'.format(pdf_url))
-
-
-def extract_affiliations(front_page, affiliations):
-    found_affiliations = []
-    for affiliation in affiliations:
-        if check_affiliation(front_page, affiliation):
-            found_affiliations.append(affiliation['name'])
-    return found_affiliations
-
-
-def check_affiliation(front_page, affiliation):
-    for pattern in affiliation['patterns']:
-        matches = find_near_matches(pattern['text'],
-                                    front_page,
-                                    max_l_dist=pattern['max_l_dist'])
-        if len(matches) > 0:
-            return True
-    return False
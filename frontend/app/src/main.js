@@ -342,15 +342,16 @@ class ScrollField extends React.Component {
     this.state = {
       items: [],
       hasMore: true,
+      nextCursor: null,
       logged_in: this.props.logged_in,
     };
   }
 
   componentDidMount() {
-    this.fetchPapers(0);
+    this.fetchPapers(null);
   }
 
-  fetchPapers = offset => {
+  fetchPapers = cursor => {
     var queryParams = '&time=' + this.props.filters.time;
 
     queryParams += '&tab=' + this.props.selected_tab;
@@ -368,12 +369,16 @@ class ScrollField extends React.Component {
       queryParams += '&categories=' + this.props.filters.categories;
     }
 
-    fetch('/api/papers?offset=' + offset + queryParams)
+    var pageParam =
+      cursor === null ? 'offset=0' : 'cursor=' + encodeURIComponent(cursor);
+
+    fetch('/api/papers?' + pageParam + queryParams)
       .then(response => response.json())
       .then(result => {
         this.setState(state => ({
           items: state.items.concat(result.papers),
-          hasMore: result.papers.length !== 0,
+          hasMore: result.next_cursor !== null,
+          nextCursor: result.next_cursor,
         }));
       });
   };
@@ -384,13 +389,13 @@ class ScrollField extends React.Component {
       this.props.query !== prevProps.query ||
       this.props.selected_tab !== prevProps.selected_tab
     ) {
-      this.setState(state => ({items: []}));
-      this.fetchPapers(0);
+      this.setState(state => ({items: [], nextCursor: null}));
+      this.fetchPapers(null);
     }
   }
 
   fetchMoreData = () => {
-    this.fetchPapers(this.state.items.length);
+    this.fetchPapers(this.state.nextCursor);
   };
 
   render() {